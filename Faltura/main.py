@@ -1,13 +1,23 @@
 import math
+import os
 
 import pygame
 
-from OnlineGraph2d.Graphics import generate_shape
+from OnlineGraph2d.Codec import encode, decode, split, join, interpolate, position
+from OnlineGraph2d.Graphics import Renderer
+from OnlineGraph2d.Level import Level, LevelStreamer
 from OnlineGraph2d.Network import Server, Client, get_ip
-from OnlineGraph2d.Physics import Object, GameObject, FollowerObject, Camera, Rope
+from OnlineGraph2d.Physics import Object, GameObject, FollowerObject, Camera, Rope, SpatialHash, EntityRegistry, ProjectilePool, BVH, FixedStep
+from OnlineGraph2d.Profiler import profiler
+from OnlineGraph2d.Replay import Recorder
 
 host_type = input('who are you? [server/client]: ').lower()
 port = 5555
+tick_rate = 30  # network updates per second, independent of the FPS
+interpolation_delay = 2 / tick_rate  # remote entities are rendered this many seconds in the past
+interest_radius = 800  # clients only get the entities within this distance of their screen
+record_path = None  # the server records the match to this file, replay it with benchmarks/replay.py
+recorder = None
 
 if host_type == 'server':
     print('\nsetting up server...')
@@ -19,12 +29,14 @@ if host_type == 'server':
     else:
         print(f'server started: the server ip is: {server_ip}')
 
-        server = Server(server_ip=server_ip, port=port)
+        if record_path:
+            recorder = Recorder(record_path)
+        server = Server(server_ip=server_ip, port=port, delta=True, tick_rate=tick_rate, interest_radius=interest_radius, position=position, recorder=recorder)
 
 elif host_type == 'client':
     server_ip = input('\nenter the server ip: ')
 
-    client = Client(server_ip=server_ip, port=port)
+    client = Client(server_ip=server_ip, port=port, delta=True, tick_rate=tick_rate)
 
 else:
     print('\nhost type not valid')
@@ -36,6 +48,8 @@ pygame.init()
 
 screen_size = (1600, 900)
 FPS = 120
+physics_rate = 120  # physics steps per second, independent of the FPS
+dirty_rendering = True  # redraw and flush only the parts of the screen that changed
 display = pygame.display.set_mode(screen_size)
 pygame.display.set_caption(host_type + ('_' + str(host.client_number) if host_type == 'client' else ''))
 clock = pygame.time.Clock()
@@ -43,6 +57,9 @@ text_font = pygame.font.SysFont('dejavusansmono', 15)
 
 close = False
 objects = {}
+remote_entities = {}
+remote_keys = set()  # collision_index keys of the remote entities at the previous frame
+received_packets = {}
 colors_rgb = [
     (0, 255, 0),  # green
     (0, 0, 255),  # blue
@@ -53,7 +70,6 @@ colors_rgb = [
     (165, 42, 42),  # brown
 ]
 variables = {}
-connection_number = 0
 weapons = ['grappling_gun', 'gun']
 weapon = 0
 mouse_pos = None
@@ -61,16 +77,24 @@ grappling_gun = None
 grappling_gun_swing = False
 
 
+def blit_text(image, pos):
+    if dirty_rendering:
+        rect = renderer.overlay(display, image, pos)  # erased by the renderer at the next frame
+        dirty_rects.append(rect)
+        return rect
+    else:
+        return display.blit(image, pos)
+
+
 class AimDot(Object):
     def __init__(self, collision, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.collision = collision
+        self.collision = collision  # BVH of the map
 
         self.mouse_pos = [0, 0]
         self.weapon = None
 
         self.grappling_gun = None
-        self.bullets = []
 
     def update(self):
         if weapon == 0:
@@ -79,58 +103,61 @@ class AimDot(Object):
             self.show = False
 
         if not self.grappling_gun and weapon == 0:
-            best_pos = None
-            min_dist = math.inf
+            # the closest point of the map to the mouse, the mouse position itself if it is inside an object
+            nearest = self.collision.nearest(self.mouse_pos)
+            if nearest:
+                self.pos = self.mouse_pos if nearest[1] == 0 else nearest[0]
 
-            for map_obj in self.collision:
-                obj_x_edge = (map_obj[0][0], map_obj[0][0] + map_obj[1][0])
-                obj_y_edge = (map_obj[0][1], map_obj[0][1] + map_obj[1][1])
 
-                if obj_x_edge[0] <= self.mouse_pos[0] <= obj_x_edge[1] and obj_y_edge[0] <= self.mouse_pos[1] <= obj_y_edge[1]:  # if the mouse is inside the object keep the mouse position
-                    self.pos = self.mouse_pos
-                    return
+# the map is streamed from its level file (written by make_map.py): the chunks around the camera are loaded in the
+# broadphase and baked in the renderer, the far ones are evicted
+level = Level(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'map.level'))
+renderer = Renderer()
 
-                current_x = max(obj_x_edge[0], min(self.mouse_pos[0], obj_x_edge[1]))
-                current_y = max(obj_y_edge[0], min(self.mouse_pos[1], obj_y_edge[1]))
-                current_pos = (current_x, current_y)
+# broadphase shared by the player and the bullets: the map chunks are inserted by the streamer, remote objects are
+# moved every frame
+collision_index = SpatialHash()
+level_streamer = LevelStreamer(level, collision=collision_index, renderer=renderer)
 
-                current_dist = (current_pos[0] - self.mouse_pos[0]) ** 2 + (current_pos[1] - self.mouse_pos[1]) ** 2
+player = GameObject(static=False, pos=[100, 100], angle=0, size=(20, 20), shape='circle', color=colors_rgb[host.client_number], layer=2, mass=1, collision=collision_index)
+camera = Camera(obj=player, rel_pos=[0, -100], screen_size=screen_size)
+level_streamer.update(camera)
+gun = FollowerObject(obj=player, rel_pos=[player.size[0] - 5, player.size[1] / 2 - 2], angle=0, size=(10, 4), shape='rect', color=(100, 100, 100), layer=5)
+aim_dot = AimDot(pos=[100, 100], angle=0, size=(7, 7), shape='circle', color=(255, 0, 0), layer=6, collision=BVH([(map_obj.pos, map_obj.size) for map_obj in level_streamer.objects.values()]), centered=True)
 
-                if current_dist < min_dist:
-                    min_dist = current_dist
-                    best_pos = current_pos
+global_objects = EntityRegistry([player, gun])  # sent to the other hosts, the bullets are added by the pool while they fly
+local_objects = [aim_dot]
 
-            self.pos = best_pos
+# when every bullet is flying the oldest one is shot again, messages are framed by Network.py so the number of
+# bullets is not bound to the socket buffer size
+max_bullets = 100
+bullets = ProjectilePool(capacity=max_bullets, lifetime=10 * physics_rate, bounds=(-3000, -2000, 3000, 2000), entities=global_objects, collision=collision_index)
 
-        # delete far bullets
-        self.bullets = [bullet for bullet in self.bullets if abs(bullet.pos[0]) < 3000 and abs(bullet.pos[1]) < 2000]
 
-        # delete old bullets if there are too much
-        max_bullets = math.floor(22 / connection_number)  # here 22 is the number of bullets the current buffer size of Network.py supports; in the future, if optimization is implemented, update this number
-        self.bullets = self.bullets[-max_bullets:]
+def step_physics():
+    # one fixed step: the movement keys held down and the updates
+    if keys[pygame.K_w] and player.can_jump:
+        player.apply_axis_vel(vel=-12, axis=1)
+    if keys[pygame.K_d]:
+        player.apply_axis_vel(vel=1, axis=0, limit=10) if run else player.apply_axis_vel(vel=1, axis=0, limit=5)
+    if keys[pygame.K_a]:
+        player.apply_axis_vel(vel=-1, axis=0, limit=-10) if run else player.apply_axis_vel(vel=-1, axis=0, limit=-5)
 
+    for game_obj in (player, gun, *local_objects):
+        try:
+            game_obj.update()
+        except AttributeError:
+            pass
+    bullets.update()
 
-game_map = [
-    GameObject(static=True, pos=[0, 500], angle=0, size=(300, 50), shape='rect', color=(255, 255, 255), layer=0),
-    GameObject(static=True, pos=[450, 0], angle=0, size=(50, 50), shape='rect', color=(255, 255, 255), layer=0),
-    GameObject(static=True, pos=[650, 500], angle=0, size=(300, 50), shape='rect', color=(255, 255, 255), layer=0),
-    GameObject(static=True, pos=[0, 450], angle=0, size=(50, 50), shape='rect', color=(255, 255, 255), layer=0)
-]
-game_map_collision = [(map_obj.pos, map_obj.size) for map_obj in game_map]
 
-player = GameObject(static=False, pos=[100, 100], angle=0, size=(20, 20), shape='circle', color=colors_rgb[host.client_number], layer=2, mass=1, collision=game_map_collision)
-camera = Camera(obj=player, rel_pos=[0, -100], screen_size=screen_size)
-gun = FollowerObject(obj=player, rel_pos=[player.size[0] - 5, player.size[1] / 2 - 2], angle=0, size=(10, 4), shape='rect', color=(100, 100, 100), layer=5)
-aim_dot = AimDot(pos=[100, 100], angle=0, size=(7, 7), shape='circle', color=(255, 0, 0), layer=6, collision=game_map_collision, centered=True)
+physics = FixedStep(step=step_physics, rate=physics_rate)
 
-global_objects = [player, gun]
-local_objects = [aim_dot]
-if host_type == 'server':
-    objects = {host.client_number: global_objects}  # initialize server's objects to have data to share at the first frame
 
 while not close:
     # clear display
-    display.fill((0, 0, 0))
+    if not dirty_rendering:
+        display.fill((0, 0, 0))
 
     # mouse input
     for event in pygame.event.get():
@@ -143,6 +170,17 @@ while not close:
         if event.type == pygame.MOUSEWHEEL:
             weapon += event.y
 
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_F3:  # toggle the profiler and its overlay
+                profiler.disable() if profiler.enabled else profiler.enable()
+            elif event.key == pygame.K_F4:  # toggle the trace recording, the trace is saved when it stops
+                if profiler.tracing:
+                    profiler.dump_trace('trace.json')
+                    profiler.disable()
+                    print('trace saved to trace.json')
+                else:
+                    profiler.enable(tracing=True)
+
         if event.type == pygame.MOUSEBUTTONDOWN:
             if weapon == 0:
                 if event.button == 1:
@@ -152,8 +190,7 @@ while not close:
                     grappling_gun = True
                     grappling_gun_swing = False
             elif weapon == 1 and event.button == 1:
-                aim_dot.bullets.append(GameObject(static=False, pos=gun.pos, angle=0, size=(5, 5), shape='circle', color=(255, 255, 255), layer=10, mass=0.1, collision=game_map_collision))
-                aim_dot.bullets[-1].apply_vel(vel=25, angle=gun.angle)
+                bullets.spawn(pos=gun.pos, vel=25, angle=gun.angle)
 
     # keyboard input
     keys = pygame.key.get_pressed()
@@ -162,16 +199,10 @@ while not close:
     else:
         run = False
 
-    if keys[pygame.K_w] and player.can_jump:
-        player.apply_axis_vel(vel=-12, axis=1)
-    if keys[pygame.K_d]:
-        player.apply_axis_vel(vel=1, axis=0, limit=10) if run else player.apply_axis_vel(vel=1, axis=0, limit=5)
-    if keys[pygame.K_a]:
-        player.apply_axis_vel(vel=-1, axis=0, limit=-10) if run else player.apply_axis_vel(vel=-1, axis=0, limit=-5)
     if keys[pygame.K_r]:
         player.pos = [100, 100]
         player.vel = [0, 0]
-        aim_dot.bullets = []
+        bullets.clear()
 
     # normalize weapon
     weapon %= len(weapons)
@@ -202,29 +233,42 @@ while not close:
         player.rope = None
 
     # transfer data
-    if host_type == 'server':
-        other_data = host.send(objects)
-        objects = {host.client_number: global_objects + aim_dot.bullets} | other_data  # update server's objects
-        connection_number = len(list(objects.keys()))
-    else:
-        objects = host.send(global_objects + aim_dot.bullets)
-        objects = {client_number: host_objs for client_number, host_objs in objects.items() if client_number != host.client_number}
-        connection_number = len(list(objects.keys())) + 1  # + 1 because clients exclude their own content (see the above line)
+    with profiler.span('network'):
+        if host_type == 'server':
+            packets = {host.client_number: encode(global_objects.values())} | received_packets  # the server relays every client's packet
+            snapshot = {(client_number, entity_id): entity_record for client_number, packet in packets.items() for entity_id, entity_record in split(packet).items()}  # per entity entries so that only changed entities are sent
+            received_packets = dict(host.send(snapshot))  # copy because connection threads keep updating it
+        else:
+            host.set_view(camera.pos, camera.screen_size)
+            host.send(encode(global_objects.values()))
+            snapshot = interpolate(*host.interpolation(interpolation_delay))  # smooth remote entities between ticks
+            client_records = {}
+            for (client_number, entity_id), entity_record in snapshot.items():
+                client_records.setdefault(client_number, []).append(entity_record)
+            packets = {client_number: join(entity_records) for client_number, entity_records in client_records.items()}
+
+        # decode the other hosts' entities, reusing the objects decoded at the previous frame
+        remote_entities = {client_number: decode(packet, remote_entities.get(client_number)) for client_number, packet in packets.items() if client_number != host.client_number}
+        objects = {client_number: list(entities.values()) for client_number, entities in remote_entities.items()}
 
     # update objects collision
-    player.collision = game_map_collision + [(obj.pos, obj.size) for client_number, host_objs in objects.items() for obj in host_objs if obj is not player]
-    for bullet in aim_dot.bullets:
-        bullet.collision = game_map_collision + [(obj.pos, obj.size) for client_number, host_objs in objects.items() for obj in host_objs if obj is not bullet]
+    previous_remote_keys, remote_keys = remote_keys, {(client_number, obj.entity_id) for client_number, host_objs in objects.items() for obj in host_objs}
+    for key in previous_remote_keys - remote_keys:
+        collision_index.remove(key)
+    for client_number, host_objs in objects.items():
+        for obj in host_objs:
+            collision_index.move((client_number, obj.entity_id), obj.pos, obj.size)
 
-    # compute positions
-    for game_obj in global_objects + local_objects + aim_dot.bullets:
-        try:
-            game_obj.update()
-        except AttributeError:
-            pass
+    # compute positions, as many fixed steps as the time elapsed since the previous frame
+    with profiler.span('physics'):
+        physics.advance(clock.get_time() / 1000)
 
     camera.update()
 
+    # stream the map, the aim dot snaps to the loaded part of it
+    if level_streamer.update(camera):
+        aim_dot.collision = BVH([(map_obj.pos, map_obj.size) for map_obj in level_streamer.objects.values()])
+
     if not player.rope:
         gun.angle = math.atan2(mouse_camera_pos[1] - gun.pos[1] + gun.size[1] / 2, mouse_camera_pos[0] - gun.pos[0] + gun.size[0] / 2)  # noqa
     else:
@@ -234,29 +278,22 @@ while not close:
 
     # display objects
     render_objs = []
-    render_objs.extend(game_map)
     render_objs.extend(local_objects)
-    if host_type == 'client':
-        render_objs.extend(global_objects + aim_dot.bullets)
+    render_objs.extend(global_objects)
     for client_objs in objects.values():
         render_objs.extend(client_objs)
 
-    render_objs.sort(key=lambda obj: obj.layer)  # sort objects by layer
-
-    for obj in render_objs:
-        try:
-            if obj.rope and obj.rope.show:
-                obj.rope.blit(display=display, camera=camera)
-        except AttributeError:
-            pass
-        if obj.show:
-            display.blit(*generate_shape(obj=obj, camera=camera))
+    # the map is already baked in the renderer
+    if dirty_rendering:
+        dirty_rects = renderer.render_dirty(display=display, camera=camera, objects=render_objs)
+    else:
+        renderer.render(display=display, camera=camera, objects=render_objs)
 
     # display variables and fps
     try:
         variables = {
             'weapon': weapons[weapon],
-            'bullets': len(aim_dot.bullets)
+            'bullets': len(bullets)
         }
     except IndexError:
         pass
@@ -264,19 +301,28 @@ while not close:
     y = 25
     for name, value in variables.items():
         if '__separator__' in name:
-            display.blit(text_font.render('_' * value, 1, (255, 255, 255)), (25, y))  # noqa
+            blit_text(text_font.render('_' * value, 1, (255, 255, 255)), (25, y))  # noqa
         else:
             try:
-                display.blit(text_font.render(f'{name}: {value}', 1, (255, 255, 255)), (25, y))
+                blit_text(text_font.render(f'{name}: {value}', 1, (255, 255, 255)), (25, y))
             except Exception as e:  # noqa
-                display.blit(text_font.render(f'{name}: None', 1, (255, 255, 255)), (25, y))
+                blit_text(text_font.render(f'{name}: None', 1, (255, 255, 255)), (25, y))
                 print(e)
         y += 25
 
-    display.blit(text_font.render(f'FPS: {clock.get_fps():.1f} / {FPS}', 1, (255, 255, 255)), (screen_size[0] - 170, 25))
+    blit_text(text_font.render(f'FPS: {clock.get_fps():.1f} / {FPS}', 1, (255, 255, 255)), (screen_size[0] - 170, 25))
+
+    if profiler.enabled:
+        profiler.overlay(display, text_font, (screen_size[0] - 420, 50), blit=blit_text)
+        profiler.frame()
 
     # render
-    pygame.display.update()
+    if dirty_rendering:
+        pygame.display.update(dirty_rects)
+    else:
+        pygame.display.update()
     clock.tick(FPS)
 
+if recorder:
+    recorder.close()
 pygame.quit()
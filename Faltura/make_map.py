@@ -0,0 +1,15 @@
+# writes the map of Faltura as a level file (see OnlineGraph2d.Level), run it again after changing the map
+import os
+
+from OnlineGraph2d.Level import save_level
+from OnlineGraph2d.Physics import GameObject
+
+game_map = [
+    GameObject(static=True, pos=[0, 500], angle=0, size=(300, 50), shape='rect', color=(255, 255, 255), layer=0),
+    GameObject(static=True, pos=[450, 0], angle=0, size=(50, 50), shape='rect', color=(255, 255, 255), layer=0),
+    GameObject(static=True, pos=[650, 500], angle=0, size=(300, 50), shape='rect', color=(255, 255, 255), layer=0),
+    GameObject(static=True, pos=[0, 450], angle=0, size=(50, 50), shape='rect', color=(255, 255, 255), layer=0)
+]
+
+if __name__ == '__main__':
+    save_level(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'map.level'), game_map)
@@ -0,0 +1,136 @@
+import math
+import struct
+
+from OnlineGraph2d.Physics import Object, GameObject, FollowerObject, Rope
+from OnlineGraph2d.Profiler import profiled
+
+# one fixed size record per entity:
+# entity_id, kind, shape, flags, layer, pos[x, y], vel[x, y], angle, size[x, y], color[r, g, b], owner_id, rope pivot[x, y]
+record = struct.Struct('!IBBBh2f2ff2f3BI2f')
+record_id = struct.Struct('!I')  # the entity id at the start of each record
+record_pos = struct.Struct('!2f')  # the entity position, after the id, kind, shape, flags and layer
+record_pos_offset = struct.calcsize('!IBBBh')
+
+kinds = (Object, GameObject, FollowerObject)  # the index in the tuple is the kind sent over the wire
+shapes = ('rect', 'circle')
+
+CENTERED, SHOW, STATIC, ROPE, ROPE_SWING, ROPE_SHOW = 1, 2, 4, 8, 16, 32
+
+
+@profiled('encode')
+def encode(objects):
+    buffer = bytearray(record.size * len(objects))
+
+    for i, obj in enumerate(objects):
+        # check the most specific class first, FollowerObject and GameObject are both Objects
+        kind = 2 if isinstance(obj, FollowerObject) else 1 if isinstance(obj, GameObject) else 0
+
+        flags = (CENTERED if obj.centered else 0) | (SHOW if obj.show else 0)
+        vel, owner_id, pivot = (0, 0), 0, (0, 0)
+
+        if kind == 1:
+            if obj.static:
+                flags |= STATIC
+            else:
+                vel = obj.vel
+
+            if obj.rope:
+                flags |= ROPE | (ROPE_SWING if obj.rope.swing else 0) | (ROPE_SHOW if obj.rope.show else 0)
+                pivot = obj.rope.pivot
+        elif kind == 2:
+            owner_id = obj.obj.entity_id
+
+        record.pack_into(buffer, i * record.size, obj.entity_id, kind, shapes.index(obj.shape), flags, obj.layer, obj.pos[0], obj.pos[1], vel[0], vel[1], obj.angle, obj.size[0], obj.size[1], *obj.color[:3], owner_id, pivot[0], pivot[1])
+
+    return bytes(buffer)
+
+
+@profiled('decode')
+def decode(data, entities=None):
+    # entities is the dict returned by the previous decode of the same sender: objects are updated in place and
+    # only new entity ids allocate a new instance, entities missing from data are dropped
+    if entities is None:
+        entities = {}
+
+    received, followers = set(), []
+
+    for entity_id, kind, shape, flags, layer, pos_x, pos_y, vel_x, vel_y, angle, size_x, size_y, r, g, b, owner_id, pivot_x, pivot_y in record.iter_unpack(data):
+        obj = entities.get(entity_id)
+        if obj is None or type(obj) is not kinds[kind]:
+            obj = entities[entity_id] = kinds[kind].__new__(kinds[kind])  # skip __init__, every field is set below
+            obj.entity_id = entity_id
+            obj.pos = [0, 0]
+            if kind == 1:
+                obj.vel, obj.rope = [0, 0], None
+
+        received.add(entity_id)
+
+        obj.pos[0], obj.pos[1] = pos_x, pos_y
+        obj.angle, obj.size, obj.shape, obj.color, obj.layer = angle, (size_x, size_y), shapes[shape], (r, g, b), layer
+        obj.centered, obj.show = bool(flags & CENTERED), bool(flags & SHOW)
+
+        if kind == 1:
+            obj.static = bool(flags & STATIC)
+            obj.vel[0], obj.vel[1] = vel_x, vel_y
+
+            if flags & ROPE:
+                if not obj.rope:
+                    obj.rope = Rope.__new__(Rope)
+                    obj.rope.obj, obj.rope.pivot, obj.rope.init_vel = obj, [0, 0], None
+                    obj.rope.ready, obj.rope.animation_steps, obj.rope.animation_pos = True, 0, [0, 0]  # remote ropes are drawn already attached
+                    obj.rope.length, obj.rope.angle = None, None
+
+                obj.rope.pivot[0], obj.rope.pivot[1] = pivot_x, pivot_y
+                obj.rope.swing, obj.rope.show, obj.rope.color = bool(flags & ROPE_SWING), bool(flags & ROPE_SHOW), obj.color
+            else:
+                obj.rope = None
+        elif kind == 2:
+            followers.append((obj, owner_id))
+
+    # the owner can be sent after its follower, so followers are linked once every record has been read
+    for obj, owner_id in followers:
+        obj.obj = entities.get(owner_id, obj)
+        obj.rel_pos = [obj.pos[0] - obj.obj.pos[0], obj.pos[1] - obj.obj.pos[1]]
+
+    for entity_id in entities.keys() - received:
+        del entities[entity_id]
+
+    return entities
+
+
+def split(data):
+    # {entity_id: record} view of an encoded buffer, used to build delta-friendly snapshots
+    data = memoryview(data)
+    return {record_id.unpack_from(data, offset)[0]: bytes(data[offset:offset + record.size]) for offset in range(0, len(data), record.size)}
+
+
+def join(records):
+    return b''.join(records)
+
+
+def position(key, entity_record):
+    # (x, y) of a record, the position function of a Server doing interest management over split snapshots
+    return record_pos.unpack_from(entity_record, record_pos_offset)
+
+
+@profiled('interpolate')
+def interpolate(snapshot_a, snapshot_b, t):
+    # snapshots are dicts {key: record}, entities in both snapshots get their position and angle blended, the others
+    # are taken from snapshot_b as they are
+    if t <= 0 and snapshot_a is snapshot_b:
+        return snapshot_b
+
+    snapshot = {}
+    for key, record_b in snapshot_b.items():
+        record_a = snapshot_a.get(key)
+        if record_a is None or record_a == record_b:
+            snapshot[key] = record_b
+            continue
+
+        fields_a, fields = record.unpack(record_a), list(record.unpack(record_b))
+        fields[5] = fields_a[5] + (fields[5] - fields_a[5]) * t  # pos x
+        fields[6] = fields_a[6] + (fields[6] - fields_a[6]) * t  # pos y
+        fields[9] = fields_a[9] + ((fields[9] - fields_a[9] + math.pi) % (2 * math.pi) - math.pi) * t  # angle, the short way around
+        snapshot[key] = record.pack(*fields)
+
+    return snapshot
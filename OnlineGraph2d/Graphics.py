@@ -1,20 +1,71 @@
+import bisect
 import math
+from collections import OrderedDict
+from types import SimpleNamespace
 
 import pygame
 
 from OnlineGraph2d.Physics import FollowerObject
+from OnlineGraph2d.Profiler import profiler, profiled
 
 
-def generate_shape(obj, camera):
-    image = pygame.Surface(obj.size, pygame.SRCALPHA)
+class SurfaceCache:
+    # bounded LRU cache of the shapes drawn by generate_shape, already rotated, the angle is rounded to one of
+    # angle_steps buckets per turn so that objects with almost the same angle share the same surface
+    def __init__(self, max_size=1024, angle_steps=360):
+        self.max_size, self.angle_steps = max_size, angle_steps
+        self.surfaces = OrderedDict()
+        self.hits, self.misses = 0, 0
 
-    if obj.shape == 'rect':
-        pygame.draw.rect(image, obj.color, image.get_rect())
-    elif obj.shape == 'circle':
-        pygame.draw.circle(image, obj.color, (obj.size[0] // 2, obj.size[1] // 2), obj.size[0] / 2)
+    def get(self, obj):
+        bucket = round(obj.angle / (2 * math.pi) * self.angle_steps) % self.angle_steps if obj.shape != 'circle' else 0
+        key = (obj.shape, tuple(obj.size), tuple(obj.color), bucket)
+
+        image = self.surfaces.get(key)
+        if profiler.enabled:
+            profiler.count('surface_cache_hits' if image is not None else 'surface_cache_misses')
+        if image is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return image
+
+        self.misses += 1
+        image = draw_shape(obj.shape, obj.size, obj.color, bucket * 2 * math.pi / self.angle_steps)
+        self.surfaces[key] = image
+        if len(self.surfaces) > self.max_size:
+            self.surfaces.popitem(last=False)  # least recently used
+        return image
+
+    def clear(self):
+        self.surfaces.clear()
+        self.hits, self.misses = 0, 0
+
+
+surface_cache = SurfaceCache()
+
+
+def draw_shape(shape, size, color, angle):
+    image = pygame.Surface(size, pygame.SRCALPHA)
+
+    if shape == 'rect':
+        pygame.draw.rect(image, color, image.get_rect())
+    elif shape == 'circle':
+        pygame.draw.circle(image, color, (size[0] // 2, size[1] // 2), size[0] / 2)
+
+    if angle != 0 and shape != 'circle':
+        image = pygame.transform.rotate(image, -math.degrees(angle))
+
+    return image
+
+
+def generate_shape(obj, camera, cache=surface_cache):
+    # the returned surface can be shared with other objects through the cache: don't draw on it
+    if cache is not None:
+        image = cache.get(obj)
+    else:
+        image = draw_shape(obj.shape, obj.size, obj.color, obj.angle)
 
     if obj.angle != 0 and obj.shape != 'circle':
-        image = pygame.transform.rotate(image, -math.degrees(obj.angle))
         rect = image.get_rect()
 
         if isinstance(obj, FollowerObject):  # if it is a Follower instance it rotates around the main object's center
@@ -36,3 +87,192 @@ def generate_shape(obj, camera):
         pos = (pos[0] - obj.size[0] / 2, pos[1] - obj.size[1] / 2)
 
     return image, pos
+
+
+def bounds(obj):
+    # rect (x0, y0, x1, y1) that contains the object whatever its angle
+    if isinstance(obj, FollowerObject):  # it rotates around the main object's center
+        center = (obj.obj.pos[0] + obj.obj.size[0] / 2, obj.obj.pos[1] + obj.obj.size[1] / 2)
+        radius = math.hypot(obj.pos[0] + obj.size[0] / 2 - center[0], obj.pos[1] + obj.size[1] / 2 - center[1]) + math.hypot(*obj.size) / 2
+    else:
+        center = (obj.pos[0] + obj.size[0] / 2, obj.pos[1] + obj.size[1] / 2)
+        radius = math.hypot(*obj.size) / 2
+
+    if obj.centered:
+        center = (center[0] - obj.size[0] / 2, center[1] - obj.size[1] / 2)
+
+    return center[0] - radius, center[1] - radius, center[0] + radius, center[1] + radius
+
+
+class Renderer:
+    # static objects are baked once into chunk_size x chunk_size surfaces (one set per layer), every frame only the
+    # chunks and the dynamic objects inside the camera view are drawn, layer by layer
+    def __init__(self, chunk_size=512, cache=surface_cache):
+        self.chunk_size, self.cache = chunk_size, cache
+        self.chunks = {}  # layer: {(chunk_x, chunk_y): surface}
+        self.layers = []  # every layer seen so far, sorted
+        self.rendered, self.culled = 0, 0  # objects drawn and skipped at the last frame
+        self.previous_camera, self.previous_rects, self.overlays = None, [], []  # dirty mode state
+
+    def add_layer(self, layer):
+        index = bisect.bisect_left(self.layers, layer)
+        if index == len(self.layers) or self.layers[index] != layer:
+            self.layers.insert(index, layer)
+
+    def bake(self, objects, area=None):
+        # area (x0, y0, x1, y1), aligned on chunks, limits the chunks drawn (e.g. one chunk of a streamed level)
+        for obj in objects:
+            if not obj.show:
+                continue
+
+            self.add_layer(obj.layer)
+            chunks = self.chunks.setdefault(obj.layer, {})
+            x0, y0, x1, y1 = bounds(obj)
+            if area:
+                x0, y0, x1, y1 = max(x0, area[0]), max(y0, area[1]), min(x1, area[2] - 1), min(y1, area[3] - 1)
+
+            for chunk_x in range(int(x0 // self.chunk_size), int(x1 // self.chunk_size) + 1):
+                for chunk_y in range(int(y0 // self.chunk_size), int(y1 // self.chunk_size) + 1):
+                    if (chunk_x, chunk_y) not in chunks:
+                        chunks[(chunk_x, chunk_y)] = pygame.Surface((self.chunk_size, self.chunk_size), pygame.SRCALPHA)
+
+                    # draw it as seen from a camera placed at the chunk origin
+                    origin = SimpleNamespace(pos=(chunk_x * self.chunk_size, chunk_y * self.chunk_size))
+                    chunks[(chunk_x, chunk_y)].blit(*generate_shape(obj=obj, camera=origin, cache=self.cache))
+
+        self.previous_camera = None  # the next dirty frame is redrawn entirely
+
+    def unbake(self, area):
+        # drops the chunks inside area (x0, y0, x1, y1), aligned on chunks
+        chunk_range = range(int(area[0] // self.chunk_size), int(area[2] // self.chunk_size)), range(int(area[1] // self.chunk_size), int(area[3] // self.chunk_size))
+        for chunks in self.chunks.values():
+            for chunk_x in chunk_range[0]:
+                for chunk_y in chunk_range[1]:
+                    chunks.pop((chunk_x, chunk_y), None)
+
+        self.previous_camera = None
+
+    def clear(self):
+        self.chunks, self.layers = {}, []
+        self.previous_camera = None  # the next dirty frame is redrawn entirely
+
+    def prepare(self, camera, objects):
+        # what to draw this frame: {layer: [(image, pos, rect) or (color, start, end, rect) for ropes]}, rects are on screen
+        view = (camera.pos[0], camera.pos[1], camera.pos[0] + camera.screen_size[0], camera.pos[1] + camera.screen_size[1])
+        self.rendered, self.culled = 0, 0
+
+        layers = {}
+        for obj in objects:
+            rope = getattr(obj, 'rope', None)
+            if rope and rope.show:  # ropes are always drawn, they can cross the view from far away
+                start, end = rope.line(camera)
+                rect = pygame.Rect(min(start[0], end[0]) - 2, min(start[1], end[1]) - 2, abs(start[0] - end[0]) + 5, abs(start[1] - end[1]) + 5)
+                layers.setdefault(obj.layer, []).append((rope.color, start, end, rect))
+
+            x0, y0, x1, y1 = bounds(obj)
+            if obj.show and x0 < view[2] and x1 > view[0] and y0 < view[3] and y1 > view[1]:
+                image, pos = generate_shape(obj=obj, camera=camera, cache=self.cache)
+                rect = pygame.Rect(int(pos[0]) - 1, int(pos[1]) - 1, image.get_width() + 2, image.get_height() + 2)  # blit truncates pos, 1px margin
+                layers.setdefault(obj.layer, []).append((image, pos, rect))
+                self.rendered += 1
+            else:
+                self.culled += 1
+
+        for layer in layers:
+            if layer not in self.chunks:
+                self.add_layer(layer)
+
+        profiler.count('objects_rendered', self.rendered)
+        profiler.count('objects_culled', self.culled)
+        return layers
+
+    def draw(self, display, camera, layers, area):
+        # draw the static chunks and the prepared objects that touch area (a screen rect), layer by layer
+        chunk_range = (int((area[0] + camera.pos[0]) // self.chunk_size), int((area[1] + camera.pos[1]) // self.chunk_size), int((area[0] + area[2] + camera.pos[0]) // self.chunk_size), int((area[1] + area[3] + camera.pos[1]) // self.chunk_size))
+
+        for layer in self.layers:
+            # static objects first, as they are below the dynamic objects of the same layer
+            chunks = self.chunks.get(layer)
+            if chunks:
+                for chunk_x in range(chunk_range[0], chunk_range[2] + 1):
+                    for chunk_y in range(chunk_range[1], chunk_range[3] + 1):
+                        chunk = chunks.get((chunk_x, chunk_y))
+                        if chunk is not None:
+                            display.blit(chunk, (chunk_x * self.chunk_size - camera.pos[0], chunk_y * self.chunk_size - camera.pos[1]))
+
+            for item in layers.get(layer, ()):
+                if not area.colliderect(item[-1]):
+                    continue
+                if len(item) == 4:  # rope
+                    pygame.draw.line(display, item[0], item[1], item[2], width=2)
+                else:
+                    display.blit(item[0], item[1])
+
+    @profiled('render')
+    def render(self, display, camera, objects):
+        self.draw(display, camera, self.prepare(camera, objects), display.get_rect())
+
+    @profiled('render')
+    def render_dirty(self, display, camera, objects, background=(0, 0, 0)):
+        # redraws only what changed since the previous render_dirty call, the display must not be cleared in between,
+        # returns the rects to pass to pygame.display.update
+        # the camera is rounded to whole pixels so that a camera movement is an exact scroll of the display
+        camera = SimpleNamespace(pos=(round(camera.pos[0]), round(camera.pos[1])), screen_size=camera.screen_size)
+        layers = self.prepare(camera, objects)
+        screen = display.get_rect()
+        drawn = [item[-1] for items in layers.values() for item in items]
+
+        if self.previous_camera is None:
+            dirty = [screen]
+        else:
+            dx, dy = camera.pos[0] - self.previous_camera[0], camera.pos[1] - self.previous_camera[1]
+            dirty = [rect.move(-dx, -dy) for rect in self.previous_rects + self.overlays]  # what was drawn last frame
+
+            if abs(dx) >= screen.width or abs(dy) >= screen.height:
+                dirty = [screen]
+            elif dx or dy:
+                # scroll what is already on screen and patch the strips it uncovers
+                display.scroll(-dx, -dy)
+                if dx:
+                    dirty.append(pygame.Rect(screen.width - dx if dx > 0 else 0, 0, abs(dx), screen.height))
+                if dy:
+                    dirty.append(pygame.Rect(0, screen.height - dy if dy > 0 else 0, screen.width, abs(dy)))
+
+            dirty.extend(drawn)
+
+        dirty = merge_rects([rect.clip(screen) for rect in dirty if rect.colliderect(screen)])
+        if sum(rect.width * rect.height for rect in dirty) > screen.width * screen.height // 2:  # cheaper as one rect
+            dirty = [screen]
+
+        for area in dirty:
+            display.set_clip(area)
+            display.fill(background)
+            self.draw(display, camera, layers, area)
+        display.set_clip(None)
+
+        self.previous_camera, self.previous_rects, self.overlays = camera.pos, drawn, []
+        return dirty
+
+    def overlay(self, display, image, pos):
+        # draws something on top of the frame in dirty mode (e.g. text), it is erased at the next render_dirty
+        rect = display.blit(image, pos)
+        self.overlays.append(rect)
+        return rect
+
+
+def merge_rects(rects):
+    # merges overlapping rects when their union is smaller than the two of them (e.g. not the scroll strips)
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        i = 0
+        while i < len(merged):
+            union = rect.union(merged[i])
+            if rect.colliderect(merged[i]) and union.width * union.height < rect.width * rect.height + merged[i].width * merged[i].height:
+                rect = union
+                merged.pop(i)
+                i = 0
+            else:
+                i += 1
+        merged.append(rect)
+    return merged
@@ -0,0 +1,178 @@
+import os
+import random
+import time
+from types import SimpleNamespace
+
+import pygame
+
+from OnlineGraph2d.Codec import decode, join
+from OnlineGraph2d.Graphics import Renderer
+from OnlineGraph2d.Physics import GameObject, FollowerObject, Camera, Rope, SpatialHash
+from OnlineGraph2d.Profiler import profiler
+from OnlineGraph2d.Replay import Replay
+
+
+def init(screen_size=(1600, 900)):
+    # pygame without a window: the dummy drivers must be selected before pygame.init
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pygame.init()
+    return pygame.Surface(screen_size)  # offscreen display
+
+
+def make_map(map_size, tile_size=50, density=0.15, seed=0):
+    # a floor plus random platforms, as static GameObjects
+    rng = random.Random(seed)
+    game_map = [GameObject(static=True, pos=[x, map_size[1] - tile_size], angle=0, size=(tile_size, tile_size), shape='rect', color=(255, 255, 255), layer=0) for x in range(0, map_size[0], tile_size)]
+
+    for y in range(tile_size * 4, map_size[1] - tile_size, tile_size * 4):
+        for x in range(0, map_size[0], tile_size):
+            if rng.random() < density:
+                game_map.append(GameObject(static=True, pos=[x, y], angle=0, size=(tile_size, tile_size // 2), shape='rect', color=(255, 255, 255), layer=0))
+
+    return game_map
+
+
+class Simulation:
+    # a scripted match: players run, jump and swing on ropes, bullets fly around the map, the first player is
+    # followed by the camera, everything is drawn offscreen when render is True
+    def __init__(self, players=2, bullets=20, map_size=(4000, 2000), screen_size=(1600, 900), render=True, seed=0):
+        self.rng = random.Random(seed)
+        self.map_size = map_size
+        self.display = init(screen_size) if render else None
+
+        self.game_map = make_map(map_size, seed=seed)
+        self.collision = SpatialHash()
+        for i, map_obj in enumerate(self.game_map):
+            self.collision.insert(('map', i), map_obj.pos, map_obj.size)
+
+        self.players, self.guns = [], []
+        for i in range(players):
+            player = GameObject(static=False, pos=[self.rng.uniform(0, map_size[0] - 20), 100], angle=0, size=(20, 20), shape='circle', color=(0, 255, 0), layer=2, mass=1, collision=self.collision)
+            self.players.append(player)
+            self.guns.append(FollowerObject(obj=player, rel_pos=[15, 8], angle=0, size=(10, 4), shape='rect', color=(100, 100, 100), layer=5))
+
+        self.bullets = []
+        for _ in range(bullets):
+            self.bullets.append(GameObject(static=False, pos=[0, 0], angle=0, size=(5, 5), shape='circle', color=(255, 255, 255), layer=10, mass=0.1, collision=self.collision))
+            self.shoot(self.bullets[-1])
+
+        self.camera = Camera(obj=self.players[0], rel_pos=[0, -100], screen_size=screen_size)
+        self.renderer = Renderer()
+        if render:
+            self.renderer.bake(self.game_map)
+
+        self.frame = 0
+
+    def shoot(self, bullet):
+        shooter = self.rng.choice(self.players)
+        bullet.pos = [shooter.pos[0], shooter.pos[1]]
+        bullet.vel = [0, 0]
+        bullet.apply_vel(vel=25, angle=self.rng.uniform(0, 6.28))
+
+    def objects(self):
+        return self.players + self.guns + self.bullets
+
+    def step(self):
+        self.frame += 1
+
+        with profiler.span('physics'):
+            self.step_physics()
+
+        if self.display:
+            self.display.fill((0, 0, 0))
+            self.renderer.render(display=self.display, camera=self.camera, objects=self.objects())
+
+        profiler.frame()
+
+    def step_physics(self):
+        for i, player in enumerate(self.players):
+            direction = 1 if (self.frame // 120 + i) % 2 == 0 else -1
+            player.apply_axis_vel(vel=direction, axis=0, limit=5 * direction)
+            if player.can_jump and self.rng.random() < 0.02:
+                player.apply_axis_vel(vel=-12, axis=1)
+
+            # swing on a rope every now and then
+            if not player.rope and self.frame % 240 == i * 17 % 240:
+                player.rope = Rope(obj=player, pivot=[player.pos[0] + 150, player.pos[1] - 300], init_vel=player.vel, swing=True, color=player.color)
+            elif player.rope and (self.frame % 240 == (i * 17 + 90) % 240 or player.can_jump):
+                player.rope = None
+
+            player.update()
+            if player.pos[1] > self.map_size[1] or not 0 <= player.pos[0] <= self.map_size[0]:  # fell out of the map
+                player.pos[0], player.pos[1] = self.map_size[0] / 2, 100
+                player.rope = None
+
+        for gun, player in zip(self.guns, self.players):
+            gun.update()
+            gun.angle = (self.frame / 30 + player.pos[0] / 100) % 6.28
+
+        for bullet in self.bullets:
+            bullet.update()
+            if not (0 <= bullet.pos[0] <= self.map_size[0] and 0 <= bullet.pos[1] <= self.map_size[1]):
+                self.shoot(bullet)
+
+        self.camera.update()
+
+
+class Playback:
+    # replays a match recorded by a Server (see Replay.Recorder) whose snapshots are Codec records keyed by
+    # (client_number, entity_id), as Faltura sends them: every tick the entities are decoded and drawn offscreen,
+    # the camera follows the first entity of the client follow (0 is the server)
+    def __init__(self, path, game_map=(), screen_size=(1600, 900), render=True, follow=0):
+        self.replay = Replay(path)
+        self.display = init(screen_size) if render else None
+        self.follow = follow
+
+        self.renderer = Renderer()
+        if render:
+            self.renderer.bake(game_map)
+        self.camera = Camera(obj=SimpleNamespace(pos=[0, 0]), rel_pos=[0, -100], screen_size=screen_size)
+
+        self.tick = 0  # next tick to play
+        self.entities = {}  # client_number: {entity_id: object}, reused by decode
+        self.inputs = []  # [(client_number, data)] received during the last tick played
+
+    def seek(self, tick):
+        self.tick = tick
+
+    def objects(self):
+        return [obj for entities in self.entities.values() for obj in entities.values()]
+
+    def step(self):
+        # plays the next tick, returns False at the end of the recording
+        if self.tick >= len(self.replay):
+            return False
+
+        snapshot = self.replay.snapshot(self.tick)
+        self.inputs = self.replay.inputs(self.tick)
+        self.tick += 1
+
+        records = {}
+        for (client_number, _), entity_record in snapshot.items():
+            records.setdefault(client_number, []).append(entity_record)
+        self.entities = {client_number: decode(join(entity_records), self.entities.get(client_number)) for client_number, entity_records in records.items()}
+
+        followed = self.entities.get(self.follow)
+        if followed:
+            self.camera.obj = next(iter(followed.values()))
+        self.camera.update()
+
+        if self.display:
+            self.display.fill((0, 0, 0))
+            self.renderer.render(display=self.display, camera=self.camera, objects=self.objects())
+
+        profiler.frame()
+        return True
+
+    def run(self, speed=None):
+        # plays until the end: as fast as possible, or speed times faster than the recorded match
+        # returns the number of ticks played
+        start, start_tick = time.perf_counter(), self.tick
+        while self.tick < len(self.replay):
+            if speed:
+                delay = (self.replay.time(self.tick) - self.replay.time(start_tick)) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.step()
+        return self.tick - start_tick
@@ -0,0 +1,139 @@
+import struct
+import zlib
+
+from OnlineGraph2d.Codec import shapes, CENTERED, SHOW
+from OnlineGraph2d.Graphics import bounds
+from OnlineGraph2d.Physics import GameObject
+
+# file layout: header, chunk directory, then the compressed chunks
+# header: magic, version, chunk_size, chunk count
+# directory entry: chunk_x, chunk_y, offset, compressed size, object count
+# chunk: zlib compressed object records, an object crossing chunks is stored in each of them with the same id
+header = struct.Struct('!4sBII')
+directory_entry = struct.Struct('!iiQII')
+object_record = struct.Struct('!I2f2ffBB3Bh')  # id, pos[x, y], size[x, y], angle, shape, flags, color[r, g, b], layer
+magic, version = b'OG2L', 1
+
+
+def save_level(path, objects, chunk_size=1024, compression=6):
+    # writes static objects (e.g. a list of GameObject(static=True, ...)) as a level, chunk_size must be a multiple
+    # of the chunk size of the Renderer that will draw it
+    chunks = {}
+    for object_id, obj in enumerate(objects):
+        data = object_record.pack(object_id, obj.pos[0], obj.pos[1], obj.size[0], obj.size[1], obj.angle, shapes.index(obj.shape), (CENTERED if obj.centered else 0) | (SHOW if obj.show else 0), *obj.color[:3], obj.layer)
+
+        # every chunk the object touches, drawn (rotated) or as a collision rect
+        x0, y0, x1, y1 = bounds(obj)
+        x0, y0, x1, y1 = min(x0, obj.pos[0]), min(y0, obj.pos[1]), max(x1, obj.pos[0] + obj.size[0]), max(y1, obj.pos[1] + obj.size[1])
+        for chunk_x in range(int(x0 // chunk_size), int(x1 // chunk_size) + 1):
+            for chunk_y in range(int(y0 // chunk_size), int(y1 // chunk_size) + 1):
+                chunks.setdefault((chunk_x, chunk_y), []).append(data)
+
+    with open(path, 'wb') as file:
+        offset = header.size + directory_entry.size * len(chunks)
+        compressed = {key: zlib.compress(b''.join(records), compression) for key, records in chunks.items()}
+
+        file.write(header.pack(magic, version, chunk_size, len(chunks)))
+        for key, data in compressed.items():
+            file.write(directory_entry.pack(key[0], key[1], offset, len(data), len(chunks[key])))
+            offset += len(data)
+        for data in compressed.values():
+            file.write(data)
+
+
+class Level:
+    # a level file opened for streaming: only the header and the chunk directory are read, the chunks are read and
+    # decompressed by load
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+
+        file_magic, file_version, self.chunk_size, count = header.unpack(self.file.read(header.size))
+        if file_magic != magic or file_version != version:
+            raise Exception(f"'{path}' is not a level")
+
+        self.directory = {}  # (chunk_x, chunk_y): (offset, compressed size, object count)
+        for chunk_x, chunk_y, offset, size, objects in directory_entry.iter_unpack(self.file.read(directory_entry.size * count)):
+            self.directory[(chunk_x, chunk_y)] = (offset, size, objects)
+
+    def chunk_range(self, x0, y0, x1, y1):
+        # the chunks of the level that touch the rect
+        return [(chunk_x, chunk_y) for chunk_x in range(int(x0 // self.chunk_size), int(x1 // self.chunk_size) + 1) for chunk_y in range(int(y0 // self.chunk_size), int(y1 // self.chunk_size) + 1) if (chunk_x, chunk_y) in self.directory]
+
+    def chunk_rect(self, key):
+        return key[0] * self.chunk_size, key[1] * self.chunk_size, (key[0] + 1) * self.chunk_size, (key[1] + 1) * self.chunk_size
+
+    def load(self, key):
+        # {object_id: GameObject} of a chunk
+        offset, size, _ = self.directory[key]
+        self.file.seek(offset)
+
+        objects = {}
+        for object_id, pos_x, pos_y, size_x, size_y, angle, shape, flags, r, g, b, layer in object_record.iter_unpack(zlib.decompress(self.file.read(size))):
+            objects[object_id] = GameObject(static=True, pos=[pos_x, pos_y], angle=angle, size=(size_x, size_y), shape=shapes[shape], color=(r, g, b), layer=layer, centered=bool(flags & CENTERED), show=bool(flags & SHOW))
+        return objects
+
+    def load_all(self):
+        objects = {}
+        for key in self.directory:
+            objects.update(self.load(key))
+        return list(objects.values())
+
+    def close(self):
+        self.file.close()
+
+
+class LevelStreamer:
+    # keeps the chunks around the camera loaded: their objects are inserted in collision (a SpatialHash, with the
+    # keys ('map', object_id)) and baked in renderer, the chunks beyond evict_margin of the view are dropped from both,
+    # so memory depends on the view and not on the size of the level
+    def __init__(self, level, collision=None, renderer=None, load_margin=512, evict_margin=1024):
+        if renderer and level.chunk_size % renderer.chunk_size:
+            raise Exception("the level chunk size must be a multiple of the renderer chunk size")
+
+        self.level, self.collision, self.renderer = level, collision, renderer
+        self.load_margin, self.evict_margin = load_margin, evict_margin
+
+        self.chunks = {}  # (chunk_x, chunk_y): [object_id], the loaded chunks
+        self.objects = {}  # object_id: GameObject, every loaded object
+        self.references = {}  # object_id: loaded chunks that contain the object
+
+    def update(self, camera):
+        # loads and evicts chunks for the camera view, returns True if the loaded objects changed
+        x0, y0 = camera.pos
+        x1, y1 = x0 + camera.screen_size[0], y0 + camera.screen_size[1]
+
+        load = [key for key in self.level.chunk_range(x0 - self.load_margin, y0 - self.load_margin, x1 + self.load_margin, y1 + self.load_margin) if key not in self.chunks]
+        keep = set(self.level.chunk_range(x0 - self.evict_margin, y0 - self.evict_margin, x1 + self.evict_margin, y1 + self.evict_margin))
+        evict = [key for key in self.chunks if key not in keep]
+
+        for key in load:
+            self.load(key)
+        for key in evict:
+            self.evict(key)
+        return bool(load or evict)
+
+    def load(self, key):
+        objects = self.level.load(key)
+        for object_id, obj in objects.items():
+            if object_id in self.objects:  # already loaded with a neighbour chunk
+                objects[object_id] = self.objects[object_id]
+            else:
+                self.objects[object_id] = obj
+                if self.collision is not None:
+                    self.collision.insert(('map', object_id), obj.pos, obj.size)
+            self.references[object_id] = self.references.get(object_id, 0) + 1
+
+        self.chunks[key] = list(objects)
+        if self.renderer:
+            self.renderer.bake(objects.values(), area=self.level.chunk_rect(key))
+
+    def evict(self, key):
+        for object_id in self.chunks.pop(key):
+            self.references[object_id] -= 1
+            if not self.references[object_id]:
+                del self.references[object_id], self.objects[object_id]
+                if self.collision is not None:
+                    self.collision.remove(('map', object_id))
+
+        if self.renderer:
+            self.renderer.unbake(self.level.chunk_rect(key))
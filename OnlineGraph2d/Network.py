@@ -1,8 +1,25 @@
+import multiprocessing
+import os
 import pickle
+import random
+import selectors
 import socket
+import struct
+import threading
+import time
+from collections import deque
 from _thread import start_new_thread
 
-buffer_size = 1024 * 8
+from OnlineGraph2d.Profiler import profiler, profiled
+
+buffer_size = 1024 * 8  # size of the chunks read from the socket
+max_message_size = 1024 * 1024  # largest accepted message, bigger payloads are rejected instead of truncated
+header = struct.Struct('!I')  # every message is prefixed by its length as a 4 bytes unsigned int (network order)
+snapshot_history = 64  # snapshots kept by delta clients as possible baselines
+snapshot_buffer_size = 32  # timestamped snapshots kept by clients for interpolation
+max_datagram_size = 65507  # largest UDP datagram, bigger UDP messages are sent as fragments
+fragment = struct.Struct('!BIHH')  # kind, sequence, index, count: header of the fragments of a UDP message
+WHOLE, FRAGMENT = 0, 1  # first byte of every UDP datagram
 
 
 def get_ip():
@@ -14,13 +31,134 @@ def get_ip():
         return None
 
 
+def recv_exact(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+
+    while received < size:
+        chunk_size = sock.recv_into(view[received:], min(size - received, buffer_size))
+        if not chunk_size:  # the other side closed the connection
+            return None
+        received += chunk_size
+
+    return bytes(data)
+
+
+def frame(payload, max_size=max_message_size):
+    if len(payload) > max_size:
+        raise ValueError(f"message of {len(payload)} bytes exceeds the limit of {max_size} bytes")
+
+    profiler.count('bytes_out', header.size + len(payload))
+    return header.pack(len(payload)) + payload
+
+
+def send_message(sock, payload, max_size=max_message_size):
+    sock.sendall(frame(payload, max_size))
+
+
+def recv_message(sock, max_size=max_message_size):
+    raw_header = recv_exact(sock, header.size)
+    if raw_header is None:
+        return None
+
+    size = header.unpack(raw_header)[0]
+    if size > max_size:
+        raise ValueError(f"incoming message of {size} bytes exceeds the limit of {max_size} bytes")
+
+    profiler.count('bytes_in', header.size + size)
+    return recv_exact(sock, size)
+
+
+def diff_snapshots(baseline, snapshot):
+    # snapshots are dicts {key: value}, values must be comparable (e.g. Codec records) and are never mutated in place
+    changed = {key: value for key, value in snapshot.items() if baseline.get(key) != value}
+    removed = [key for key in baseline if key not in snapshot]
+    return changed, removed
+
+
+def patch_snapshot(baseline, changed, removed):
+    snapshot = dict(baseline)
+    snapshot.update(changed)
+    for key in removed:
+        del snapshot[key]
+    return snapshot
+
+
+class InterestGrid:
+    # grid based relevance index over a snapshot: the entries are bucketed by the position returned by
+    # position(key, value) once per snapshot, visible returns the entries in the cells around a view
+    # entries without a position (position returns None) are visible from everywhere
+    def __init__(self, snapshot, position, cell_size=512):
+        self.cell_size = cell_size
+        self.cells, self.everywhere = {}, {}
+
+        for key, value in snapshot.items():
+            pos = position(key, value)
+            if pos is None:
+                self.everywhere[key] = value
+            else:
+                self.cells.setdefault((int(pos[0] // cell_size), int(pos[1] // cell_size)), {})[key] = value
+
+    def visible(self, view, radius):
+        # view is (x, y, width, height), e.g. the camera pos and screen size, radius is the margin around it
+        x0, y0 = int((view[0] - radius) // self.cell_size), int((view[1] - radius) // self.cell_size)
+        x1, y1 = int((view[0] + view[2] + radius) // self.cell_size), int((view[1] + view[3] + radius) // self.cell_size)
+
+        snapshot = dict(self.everywhere)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):  # the view is bigger than the populated area
+            for (cell_x, cell_y), entries in self.cells.items():
+                if x0 <= cell_x <= x1 and y0 <= cell_y <= y1:
+                    snapshot.update(entries)
+        else:
+            for cell_x in range(x0, x1 + 1):
+                for cell_y in range(y0, y1 + 1):
+                    entries = self.cells.get((cell_x, cell_y))
+                    if entries:
+                        snapshot.update(entries)
+        return snapshot
+
+
 class Server:
-    def __init__(self, server_ip, port):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock_type = socket.SOCK_STREAM
+
+    def __init__(self, server_ip, port, max_size=max_message_size, delta=False, keyframe_interval=60, tick_rate=None, interest_radius=None, position=None, interest_cell_size=512, recorder=None):
+        self.sock = None
+        if server_ip is not None:  # rooms have no socket of their own, see RoomServer
+            self.sock = socket.socket(socket.AF_INET, self.sock_type)
+            self.sock.bind((server_ip, port))
         self.client_number = 0
-        self.sock.bind((server_ip, port))
-        self.to_send, self.to_get = {}, {}
+        self.max_size = max_size
+        self.to_send, self.to_get = pickle.dumps({}), {}
+        self.connections, self.acks, self.last_keyframes = {}, {}, {}
+        self.outgoing = {}  # tick mode, connection_number: [frame or None, threading.Event], see send_loop
+
+        # delta mode: data passed to send must be a snapshot dict, each client only gets the entries changed since
+        # the last snapshot it acknowledged, plus a full keyframe every keyframe_interval ticks
+        self.delta, self.keyframe_interval = delta, keyframe_interval
+        self.tick, self.snapshots, self.deltas = 0, {0: {}}, {}  # snapshots of the last keyframe_interval ticks are kept as baselines
+        self.lock = threading.Lock()
+
+        # tick mode: instead of answering every client message, the latest data is broadcast tick_rate times per second
+        self.tick_rate = tick_rate
+
+        # interest management (delta mode only): clients that report their view (Client.set_view) only get the
+        # entries within interest_radius of it, position(key, value) gives the (x, y) of an entry or None
+        if interest_radius is not None and not (delta and position):
+            raise Exception("interest management needs delta mode and a 'position' function")
+        self.interest_radius, self.position, self.interest_cell_size = interest_radius, position, interest_cell_size
+        self.interest_grid = None  # InterestGrid of the current snapshot
+        self.views, self.client_snapshots = {}, {}  # connection_number: view, connection_number: {tick: snapshot sent}
+
+        # Replay.Recorder that gets the data of every send and every message received from the clients
+        self.recorder = recorder
+
+        self.start()
+
+    def start(self):
         start_new_thread(self.wait_connection, ())
+        if self.tick_rate:
+            start_new_thread(self.tick_loop, ())
 
     def wait_connection(self):
         connection_number = 0
@@ -37,45 +175,1020 @@ class Server:
             start_new_thread(self.threaded_client, (connection, connection_number))
 
     def threaded_client(self, connection, connection_number):  # noqa
-        connection.sendall(pickle.dumps(connection_number))
+        send_message(connection, pickle.dumps(connection_number), self.max_size)
+        if self.tick_rate:
+            self.outgoing[connection_number] = [None, threading.Event()]
+            start_new_thread(self.send_loop, (connection_number, connection))
+        self.connections[connection_number] = connection
 
         while True:
             try:
-                data = pickle.loads(connection.recv(buffer_size))
+                message = recv_message(connection, self.max_size)
 
-                if not data:
+                if message is None:
                     print('SERVER: disconnected')
-                    del self.to_get[connection_number]
                     break
-                else:
-                    self.to_get[connection_number] = data
 
-                connection.sendall(self.to_send)
+                self.receive(connection_number, message)
+
+                if not self.tick_rate:
+                    send_message(connection, self.reply(connection_number), self.max_size)
 
             except Exception as e:
                 print(f'SERVER: {e}')
-                del self.to_get[connection_number]
                 break
 
         print('SERVER: connection lost')
-        connection.close()
+        self.disconnect(connection_number)
+
+    def tick_loop(self):
+        tick_time = 1 / self.tick_rate
+        next_tick = time.perf_counter()
+
+        while True:
+            for connection_number in list(self.connections):
+                if self.outgoing.get(connection_number, [None])[0] is not None:  # clients still receiving the previous tick skip this one
+                    continue
+                try:
+                    self.transmit(connection_number, self.reply(connection_number))
+                except (OSError, KeyError):  # the receiving thread notices the broken connection and cleans it up
+                    pass
+                except Exception as e:  # e.g. a snapshot over max_size: this client skips the tick, the others still get it
+                    print(f'SERVER: {e}')
+
+            # sleep until the next tick, ticks that are already late are skipped instead of being sent in a burst
+            next_tick += tick_time
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.perf_counter()
+
+    def transmit(self, connection_number, payload):
+        outgoing = self.outgoing[connection_number]
+        outgoing[0] = frame(payload, self.max_size)
+        outgoing[1].set()
+
+    def send_loop(self, connection_number, connection):
+        # tick mode: sends the frames queued by tick_loop to one connection, so a client that stops reading only
+        # blocks its own thread instead of the broadcast to every client
+        outgoing = self.outgoing[connection_number]
+
+        while connection_number in self.outgoing:
+            if not outgoing[1].wait(timeout=0.1):  # wake up at least to check the connection is still open
+                continue
+            outgoing[1].clear()
+
+            try:
+                connection.sendall(outgoing[0])
+            except OSError:  # the receiving thread notices the broken connection and cleans it up
+                break
+            outgoing[0] = None
+
+    def disconnect(self, connection_number):
+        connection = self.connections.pop(connection_number, None)
+        self.outgoing.pop(connection_number, None)
+        self.to_get.pop(connection_number, None)
+        self.acks.pop(connection_number, None)
+        self.last_keyframes.pop(connection_number, None)
+        self.views.pop(connection_number, None)
+        self.client_snapshots.pop(connection_number, None)
+        if connection:
+            connection.close()
+
+    def receive(self, connection_number, message):
+        if self.delta:
+            message = pickle.loads(message)
+            self.acks[connection_number], self.to_get[connection_number] = message[:2]
+            if len(message) > 2:
+                self.views[connection_number] = message[2]
+        else:
+            self.to_get[connection_number] = pickle.loads(message)
+
+        if self.recorder:
+            self.recorder.record_input(connection_number, self.to_get[connection_number])
+
+    def reply(self, connection_number):
+        if self.delta:
+            return self.delta_message(connection_number)
+        return self.to_send
+
+    def delta_message(self, connection_number):
+        ack, last_keyframe = self.acks.get(connection_number), self.last_keyframes.get(connection_number)
 
+        if self.interest_radius is not None and self.views.get(connection_number):
+            return self.interest_message(connection_number, ack, last_keyframe)
+
+        with self.lock:
+            tick = self.tick
+
+            if ack not in self.snapshots or last_keyframe is None or tick - last_keyframe >= self.keyframe_interval:
+                self.last_keyframes[connection_number] = tick
+                return pickle.dumps((tick, None, self.snapshots[tick], []))
+
+            # clients acknowledging the same baseline share the encoded delta
+            if ack not in self.deltas:
+                self.deltas[ack] = pickle.dumps((tick, ack, *diff_snapshots(self.snapshots[ack], self.snapshots[tick])))
+            return self.deltas[ack]
+
+    def interest_message(self, connection_number, ack, last_keyframe):
+        # like delta_message, but the snapshots are filtered for the client, so its baselines are the snapshots it got
+        with self.lock:
+            tick = self.tick
+            if self.interest_grid is None:
+                self.interest_grid = InterestGrid(self.snapshots[tick], self.position, self.interest_cell_size)
+            snapshot = self.interest_grid.visible(self.views[connection_number], self.interest_radius)
+
+        history = self.client_snapshots.setdefault(connection_number, {})
+        for old_tick in [old_tick for old_tick in history if old_tick <= tick - self.keyframe_interval]:
+            del history[old_tick]
+
+        # the baseline is read before history[tick] is replaced: the client may have acknowledged this tick already
+        if ack not in history or last_keyframe is None or tick - last_keyframe >= self.keyframe_interval:
+            self.last_keyframes[connection_number] = tick
+            message = pickle.dumps((tick, None, snapshot, []))
+        else:
+            message = pickle.dumps((tick, ack, *diff_snapshots(history[ack], snapshot)))
+        history[tick] = snapshot
+        return message
+
+    @profiled('network_send')
     def send(self, data):
-        self.to_send = pickle.dumps(data)
+        if self.delta:
+            with self.lock:
+                self.tick += 1
+                self.snapshots[self.tick] = dict(data)
+                self.snapshots.pop(self.tick - self.keyframe_interval, None)
+                self.deltas, self.interest_grid = {}, None  # the grid is built by the first client that needs it
+        else:
+            self.to_send = pickle.dumps(data)
+
+        if self.recorder:
+            self.recorder.record(data)
         return self.to_get
 
 
-class Client:
-    def __init__(self, server_ip, port):
+class SelectorServer(Server):
+    # same interface as Server, but every connection is served by a single thread through a selectors event loop
+    # instead of a thread per client, so one process can host hundreds of connections (and many servers)
+
+    def start(self):
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}  # connection_number: [incoming bytes, outgoing bytes]
+        self.running = True
+
+        self.sock.listen()
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        print('\nSERVER: waiting for connection')
+
+        self.thread = threading.Thread(target=self.event_loop, daemon=True)
+        self.thread.start()
+
+    def event_loop(self):
+        self.connection_count = 0
+        tick_time = 1 / self.tick_rate if self.tick_rate else None
+        next_tick = time.perf_counter()
+
+        try:
+            while self.running:
+                timeout = max(0, next_tick - time.perf_counter()) if tick_time else 0.1  # wake up at least to check self.running
+                for key, events in self.selector.select(min(timeout, 0.1)):
+                    if key.fileobj is self.sock:
+                        self.accept()
+                        continue
+
+                    try:
+                        if events & selectors.EVENT_READ:
+                            self.read(key.data)
+                        if events & selectors.EVENT_WRITE and key.data in self.buffers:
+                            self.write(key.data)
+                    except Exception as e:
+                        self.connection_error(key.data, e)
+
+                if tick_time and time.perf_counter() >= next_tick:
+                    self.broadcast()
+
+                    next_tick += tick_time
+                    if next_tick < time.perf_counter():  # skip late ticks
+                        next_tick = time.perf_counter() + tick_time
+        finally:
+            for connection_number in list(self.connections):
+                self.disconnect(connection_number)
+            self.selector.unregister(self.sock)
+            self.selector.close()
+            self.sock.close()
+
+    def connection_error(self, connection_number, error):
+        print(f'SERVER: {error}')
+        print('SERVER: connection lost')
+        self.disconnect(connection_number)
+
+    def accept(self):
+        connection, address = self.sock.accept()
+        print(f'SERVER: connected to: {address[0]}')
+        return self.add_connection(connection)
+
+    def add_connection(self, connection, client_number=None):
+        # client_number is the number sent to the client, the connection number by default
+        connection.setblocking(False)
+        self.connection_count += 1
+        connection_number = self.connection_count
+
+        self.connections[connection_number] = connection
+        self.buffers[connection_number] = [bytearray(), bytearray()]
+        self.selector.register(connection, selectors.EVENT_READ, connection_number)
+        self.queue(connection_number, pickle.dumps(connection_number if client_number is None else client_number))
+        return connection_number
+
+    def broadcast(self):
+        for connection_number in list(self.connections):
+            if not self.buffers[connection_number][1]:  # clients still receiving the previous tick skip this one
+                try:
+                    self.queue(connection_number, self.reply(connection_number))
+                except Exception as e:  # e.g. a snapshot over max_size: this client skips the tick, the others still get it
+                    print(f'SERVER: {e}')
+
+    def read(self, connection_number):
+        data = self.connections[connection_number].recv(buffer_size)
+        if not data:
+            print('SERVER: disconnected')
+            self.disconnect(connection_number)
+            return
+
+        incoming = self.buffers[connection_number][0]
+        incoming += data
+        profiler.count('bytes_in', len(data))
+
+        # handle every complete message in the buffer
+        while len(incoming) >= header.size:
+            size = header.unpack_from(incoming)[0]
+            if size > self.max_size:
+                raise ValueError(f"incoming message of {size} bytes exceeds the limit of {self.max_size} bytes")
+            if len(incoming) < header.size + size:
+                break
+
+            message = bytes(incoming[header.size:header.size + size])
+            del incoming[:header.size + size]
+
+            self.receive(connection_number, message)
+            if not self.tick_rate:
+                self.queue(connection_number, self.reply(connection_number))
+
+    def write(self, connection_number):
+        outgoing = self.buffers[connection_number][1]
+        del outgoing[:self.connections[connection_number].send(outgoing)]
+
+        if not outgoing:
+            self.selector.modify(self.connections[connection_number], selectors.EVENT_READ, connection_number)
+
+    def queue(self, connection_number, payload):
+        data = frame(payload, self.max_size)
+        outgoing = self.buffers[connection_number][1]
+        if not outgoing:
+            self.selector.modify(self.connections[connection_number], selectors.EVENT_READ | selectors.EVENT_WRITE, connection_number)
+        outgoing += data
+
+    def disconnect(self, connection_number):
+        connection = self.connections.get(connection_number)
+        if connection:
+            self.selector.unregister(connection)
+        self.buffers.pop(connection_number, None)
+        super().disconnect(connection_number)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+
+
+class Room(Server):
+    # one match hosted by a RoomServer, with the delta, keyframe and interest options of Server: every tick step
+    # broadcasts update({connection_number: data}) of the clients in the room, update relays the clients' data as
+    # it is by default, subclasses can run the match simulation there instead
+    # a Room has no socket, its connections are served by the RoomWorker it belongs to
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.connection_count = 0  # the clients are numbered per room, from 1
+        self.joined = 0  # connections received, reported to the RoomServer when the room closes
+        super().__init__(None, None, **kwargs)
+
+    def start(self):
+        pass
+
+    def step(self):
+        self.send(self.update(dict(self.to_get)))
+
+    def update(self, received):
+        return received
+
+
+class RoomWorker(SelectorServer):
+    # the rooms of one process: a SelectorServer whose connections are handed over by the RoomServer through pipe
+    # (with the name of the room to join) instead of being accepted, each connection is served by its room under
+    # its number in the room, the closed rooms are reported back through pipe
+    def __init__(self, pipe, room=Room, max_size=max_message_size, tick_rate=30, room_kwargs=None):
+        self.pipe, self.room, self.room_kwargs = pipe, room, room_kwargs or {}
+        self.rooms, self.room_of = {}, {}  # name: Room, connection_number: (Room, number in the room)
+        self.parent = multiprocessing.parent_process()
+        super().__init__(None, None, max_size=max_size, tick_rate=tick_rate)
+
+    def start(self):
+        self.sock = self.pipe
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        self.running = True
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def accept(self):
+        try:
+            name, connection = self.sock.recv()
+        except EOFError:  # the RoomServer is gone
+            self.running = False
+            return None
+
+        if name not in self.rooms:
+            self.rooms[name] = self.room(name, max_size=self.max_size, tick_rate=self.tick_rate, **self.room_kwargs)
+            print(f'SERVER: room {name} opened in process {os.getpid()}')
+
+        room = self.rooms[name]
+        room.connection_count += 1
+        room.joined += 1
+        number = room.connection_count
+
+        connection_number = self.add_connection(connection, number)
+        self.room_of[connection_number] = (room, number)
+        room.connections[number] = connection
+        return connection_number
+
+    def broadcast(self):
+        if self.parent is not None and not self.parent.is_alive():  # the pipe alone can be kept open by other workers
+            self.running = False
+
+        for room in self.rooms.values():
+            room.step()
+        super().broadcast()
+
+    def receive(self, connection_number, message):
+        room, number = self.room_of[connection_number]
+        room.receive(number, message)
+
+    def reply(self, connection_number):
+        room, number = self.room_of[connection_number]
+        return room.reply(number)
+
+    def disconnect(self, connection_number):
+        super().disconnect(connection_number)
+        room, number = self.room_of.pop(connection_number, (None, None))
+        if room:
+            room.disconnect(number)
+            if not room.connections:
+                del self.rooms[room.name]
+                print(f'SERVER: room {room.name} closed')
+                try:
+                    self.pipe.send((room.name, room.joined))
+                except OSError:  # the RoomServer is gone
+                    self.running = False
+
+
+def run_room_worker(pipe, room, max_size, tick_rate, room_kwargs):
+    RoomWorker(pipe, room, max_size, tick_rate, room_kwargs).event_loop()
+
+
+class RoomServer:
+    # many matches behind one port: a client first sends the name of the room it joins (see RoomClient), the room
+    # is created by the first client joining it, the rooms are spread over worker processes (one per core by
+    # default), each runs its rooms' tick loops, so the matches use every core
+    # room is the Room class (or subclass) of the rooms, room_kwargs are passed to it (e.g. delta=True)
+    def __init__(self, server_ip, port, room=Room, workers=None, max_size=max_message_size, tick_rate=30, join_timeout=5, **room_kwargs):
+        if not tick_rate:
+            raise ValueError("'tick_rate' is required, the rooms are only stepped on the workers' ticks")
+
+        self.max_size, self.join_timeout = max_size, join_timeout
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind((server_ip, port))
+
+        self.workers = []  # [process, pipe, lock, number of open rooms]
+        for _ in range(workers or os.cpu_count() or 1):
+            pipe, worker_pipe = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_room_worker, args=(worker_pipe, room, max_size, tick_rate, room_kwargs), daemon=True)
+            process.start()
+            worker_pipe.close()
+            self.workers.append([process, pipe, threading.Lock(), 0])
+        self.rooms = {}  # name: [worker index, connections sent], a room stays in the same process while it is open
+        self.lock = threading.Lock()
+
+        start_new_thread(self.wait_connection, ())
+        for index in range(len(self.workers)):
+            start_new_thread(self.watch_worker, (index,))
+
+    def wait_connection(self):
+        self.sock.listen()
+        print('\nSERVER: waiting for connection')
+
+        while True:
+            try:
+                connection, address = self.sock.accept()
+            except OSError:  # the socket was closed
+                break
+
+            print(f'SERVER: connected to: {address[0]}')
+            start_new_thread(self.join, (connection,))
 
+    def join(self, connection):
         try:
-            self.sock.connect((server_ip, port))
-            self.client_number = pickle.loads(self.sock.recv(buffer_size))
+            connection.settimeout(self.join_timeout)
+            message = recv_message(connection, self.max_size)
+            if message is None:
+                raise ConnectionError('disconnected before joining a room')
+            name = pickle.loads(message)
+            connection.settimeout(None)
+
+            with self.lock:
+                if name not in self.rooms:  # new rooms go to the process with the fewest open rooms
+                    index = min(range(len(self.workers)), key=lambda index: self.workers[index][3])
+                    self.rooms[name] = [index, 0]
+                    self.workers[index][3] += 1
+                self.rooms[name][1] += 1
+                worker = self.workers[self.rooms[name][0]]
+
+            # outside self.lock, so that a slow worker doesn't block the joins to the other ones
+            with worker[2]:
+                worker[1].send((name, connection))  # the socket is duplicated into the worker process
+        except Exception as e:
+            print(f'SERVER: {e}')
+        finally:
+            connection.close()
+
+    def watch_worker(self, index):
+        # the rooms closed by a worker are forgotten, unless a client was on its way to them: the worker then opens
+        # the room again for it, and it is still counted here
+        pipe = self.workers[index][1]
+        while True:
+            try:
+                name, joined = pipe.recv()
+            except (EOFError, OSError):  # the worker or the pipe is closed
+                break
+
+            with self.lock:
+                room = self.rooms.get(name)
+                if room is None or room[0] != index:
+                    continue
+                room[1] -= joined
+                if room[1] <= 0:
+                    del self.rooms[name]
+                    self.workers[index][3] -= 1
+
+    def close(self):
+        self.sock.close()
+        for process, pipe, _, _ in self.workers:
+            pipe.close()
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+
+
+class Client:
+    def __init__(self, server_ip, port, max_size=max_message_size, delta=False, tick_rate=None):
+        self.max_size = max_size
+
+        # delta mode: the last snapshot received is acknowledged with every send and the server's deltas are applied to it
+        self.delta = delta
+        self.tick, self.snapshot, self.snapshots = None, {}, {}
+        self.view = None  # (x, y, width, height) sent to servers doing interest management, see set_view
+
+        # tick mode (the server must use tick mode too): all the I/O runs on background threads, send only stores the
+        # data for the sending thread (at most tick_rate messages per second) and returns the latest snapshot
+        self.tick_rate = tick_rate
+        self.pending, self.new_data = None, threading.Event()
+        self.received = deque(maxlen=snapshot_buffer_size)  # (receive time, snapshot), the newest on the right
+        self.connected = False
+
+        try:
+            self.client_number = self.connect(server_ip, port)
             print(f'\nCLIENT: connection successful (client number: {self.client_number})')
         except socket.error:
             print('\nCLIENT: connection failed')
+        else:
+            self.connected = True
+            if self.tick_rate:
+                start_new_thread(self.receive_loop, ())
+                start_new_thread(self.send_loop, ())
 
+    def connect(self, server_ip, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect((server_ip, port))
+        return pickle.loads(recv_message(self.sock, self.max_size))
+
+    def send_payload(self, payload):
+        send_message(self.sock, payload, self.max_size)
+
+    def recv_payload(self):
+        message = recv_message(self.sock, self.max_size)
+        if message is None:
+            raise ConnectionError('connection closed by the server')
+        return message
+
+    def set_view(self, pos, size):
+        # the area the client shows (e.g. Camera.pos and Camera.screen_size), sent with the next messages
+        self.view = (pos[0], pos[1], size[0], size[1])
+
+    def message(self, data):
+        if not self.delta:
+            return pickle.dumps(data)
+        return pickle.dumps((self.tick, data) if self.view is None else (self.tick, data, self.view))
+
+    @profiled('network_send')
     def send(self, data):
-        self.sock.send(pickle.dumps(data))
-        return pickle.loads(self.sock.recv(buffer_size))
+        if self.tick_rate:
+            self.pending = data
+            self.new_data.set()
+            return self.snapshot
+
+        self.send_payload(self.message(data))
+        return self.receive()
+
+    def latest_snapshot(self):
+        return self.snapshot
+
+    def interpolation(self, delay):
+        # the two received snapshots around (now - delay) and the progress between them, used to render remote
+        # entities slightly in the past so that they move smoothly between network ticks
+        render_time = time.perf_counter() - delay
+        received = list(self.received)  # copy because the receiving thread keeps appending to it
+
+        if not received:
+            return {}, {}, 0
+        if render_time >= received[-1][0]:  # no extrapolation, stay on the newest snapshot
+            return received[-1][1], received[-1][1], 0
+
+        for (time_a, snapshot_a), (time_b, snapshot_b) in zip(reversed(received[:-1]), reversed(received)):
+            if time_a <= render_time:
+                return snapshot_a, snapshot_b, (render_time - time_a) / (time_b - time_a)
+
+        return received[0][1], received[0][1], 0
+
+    def send_loop(self):
+        tick_time = 1 / self.tick_rate
+
+        while self.connected:
+            if not self.new_data.wait(timeout=0.1):  # wake up at least to check self.connected
+                continue
+            self.new_data.clear()
+
+            sent_at = time.perf_counter()
+            try:
+                self.send_payload(self.message(self.pending))
+            except OSError:  # the receiving thread notices the broken connection
+                break
+            except Exception as e:  # e.g. data over max_size or not picklable: this message is skipped
+                print(f'CLIENT: {e}')
+
+            time.sleep(max(0, sent_at + tick_time - time.perf_counter()))
+
+    def receive(self):
+        message = self.recv_payload()
+
+        if self.delta:
+            self.apply_delta(pickle.loads(message))
+        else:
+            self.snapshot = pickle.loads(message)
+
+        self.received.append((time.perf_counter(), self.snapshot))
+        return self.snapshot
+
+    def receive_loop(self):
+        while True:
+            try:
+                self.receive()
+            except Exception as e:
+                print(f'CLIENT: {e}')
+                break
+
+        print('CLIENT: connection lost')
+        self.connected = False
+        self.sock.close()
+
+    def apply_delta(self, message):
+        tick, baseline, changed, removed = message
+
+        if baseline is None:  # keyframe
+            snapshot = changed
+        elif baseline in self.snapshots:
+            snapshot = patch_snapshot(self.snapshots[baseline], changed, removed)
+        else:  # the baseline is too old: stop acknowledging so that the server answers with a keyframe
+            self.tick = None
+            return self.snapshot
+
+        self.snapshots[tick] = snapshot
+        if len(self.snapshots) > snapshot_history:
+            del self.snapshots[next(iter(self.snapshots))]  # dicts keep insertion order, the first one is the oldest
+        self.tick, self.snapshot = tick, snapshot
+        return self.snapshot
+
+
+class RoomClient(Client):
+    # Client of a RoomServer, room is the name of the room to join
+    def __init__(self, *args, room='lobby', **kwargs):
+        kwargs.setdefault('tick_rate', 30)  # the rooms broadcast on their own ticks
+        self.room = room
+        super().__init__(*args, **kwargs)
+
+    def connect(self, server_ip, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect((server_ip, port))
+        send_message(self.sock, pickle.dumps(self.room), self.max_size)
+        return pickle.loads(recv_message(self.sock, self.max_size))
+
+
+class Lockstep:
+    # input-only networking for deterministic games: the peers exchange the input of every tick instead of the world
+    # and each of them runs the same simulation on the same inputs, so the bandwidth doesn't depend on the world
+    # host is a Server or a Client without delta mode (of a Server or a LockstepRoom), peers are the client numbers
+    # of every player of the match (the server is 0), step(tick, inputs) simulates one tick, inputs is {peer: input}
+    # sorted by peer, None for the first input_delay ticks: the result must only depend on the inputs and on the
+    # previous ticks (fixed steps, seeded randomness, the same update order on every peer)
+    # the local input is used input_delay ticks after it is given so that it has time to reach the other peers, a
+    # tick is only simulated once the inputs of every peer are known: the simulation waits, it never rolls back
+    # a peer that disconnects is removed at the tick chosen by the relay (the Server or the LockstepRoom, see
+    # LockstepRelay), so that every peer simulates the same ticks with it
+    def __init__(self, host, peers, step, input_delay=3, checksum=None):
+        self.host, self.number = host, host.client_number
+        self.peers = frozenset(peers) | {host.client_number}
+        self.step, self.input_delay = step, input_delay
+        self.checksum = checksum  # checksum() of the simulation state, compared between peers to detect desyncs
+
+        self.tick = 0  # next tick to simulate
+        self.scheduled = input_delay  # next tick to get a local input
+        self.inputs = {tick: dict.fromkeys(self.peers) for tick in range(input_delay)}  # tick: {peer: input}, not simulated yet
+        self.sent = {}  # tick: local input, sent until every peer has simulated the tick
+        self.peer_ticks = dict.fromkeys(self.peers, 0)  # next tick to simulate of each peer, as last reported
+        self.checksums = {}  # tick: local checksum after the tick
+        self.desync = None  # first tick whose checksum differs from a peer's one
+        self.removals = {}  # peer: tick from which it is simulated without, chosen by the relay
+        self.relay = LockstepRelay() if isinstance(host, Server) else None
+
+    def remove_peer(self, peer):
+        # the next ticks are simulated without peer, its inputs that were not simulated yet are dropped: called at the
+        # removal tick chosen by the relay, other calls may desync the peers
+        self.removals.pop(peer, None)
+        if peer == self.number or peer not in self.peers:
+            return
+
+        self.peers -= {peer}
+        del self.peer_ticks[peer]
+        for inputs in self.inputs.values():
+            inputs.pop(peer, None)
+        print(f'LOCKSTEP: peer {peer} removed')
+
+    def waiting(self):
+        # the peers whose input of the next tick is missing
+        return self.peers - self.inputs.get(self.tick, {}).keys()
+
+    def advance(self, player_input):
+        # call it once per fixed step (see Physics.FixedStep): schedules player_input, exchanges the inputs and
+        # simulates the ticks whose inputs are all known, returns the number of ticks simulated
+        # while the simulation waits for a peer the local inputs are dropped instead of piling up
+        if self.scheduled <= self.tick + self.input_delay:
+            self.sent[self.scheduled] = player_input
+            self.inputs.setdefault(self.scheduled, {})[self.number] = player_input
+            self.scheduled += 1
+
+        self.exchange()
+
+        ticks = 0
+        while True:
+            for peer in [peer for peer, tick in self.removals.items() if tick <= self.tick]:
+                self.remove_peer(peer)
+            if len(self.inputs.get(self.tick, ())) != len(self.peers):
+                break
+
+            inputs = self.inputs.pop(self.tick)
+            self.step(self.tick, {peer: inputs[peer] for peer in sorted(inputs)})
+            if self.checksum:
+                self.checksums[self.tick] = self.checksum()
+            self.tick += 1
+            ticks += 1
+
+        profiler.count('lockstep_ticks', ticks)
+        return ticks
+
+    def exchange(self):
+        # every message carries the local inputs that a peer may still miss, so the messages overwritten before being
+        # sent (tick mode) or relayed late lose nothing
+        self.peer_ticks[self.number] = self.tick
+        oldest = min(self.peer_ticks.values())
+        for tick in [tick for tick in self.sent if tick < oldest]:
+            del self.sent[tick]
+        for tick in [tick for tick in self.checksums if tick < oldest - 1]:
+            del self.checksums[tick]
+
+        last = self.tick - 1
+        message = (self.tick, dict(self.sent), (last, self.checksums[last]) if last in self.checksums else None)  # copy, tick mode pickles it on another thread
+
+        if self.relay:
+            messages = dict(self.host.to_get)  # copy because connection threads keep updating it
+            messages[self.number] = message
+            messages = self.relay.relay(messages)
+            self.host.send(messages)
+        else:
+            messages = self.host.send(message)
+
+        for peer, peer_message in messages.items():
+            if peer == self.number or peer not in self.peers:
+                continue
+
+            peer_tick, peer_inputs, peer_checksum = peer_message[:3]
+            if len(peer_message) > 3:  # the peer is gone, see LockstepRelay
+                self.removals[peer] = peer_message[3]
+
+            self.peer_ticks[peer] = max(self.peer_ticks[peer], peer_tick)
+            for tick, peer_input in peer_inputs.items():
+                if tick >= self.tick:
+                    self.inputs.setdefault(tick, {})[peer] = peer_input
+
+            if peer_checksum and self.desync is None:
+                tick, value = peer_checksum
+                if tick in self.checksums and self.checksums[tick] != value:
+                    self.desync = tick
+                    print(f'LOCKSTEP: desync with peer {peer} at tick {tick}')
+
+
+class LockstepRelay:
+    # picks the tick at which the peers of a Lockstep match remove a peer that disconnected: the tick after its last
+    # input relayed, and keeps relaying its last message (with that tick) until every peer simulated the tick, so
+    # that every peer gets the same inputs of it before removing it at the same tick
+    def __init__(self):
+        self.last, self.departed = {}, {}  # peer: last message relayed, peer: last message + removal tick
+
+    def relay(self, messages):
+        # messages is {peer: message} of the connected peers, returns the messages to send to every peer
+        for peer in self.last.keys() - messages.keys():
+            peer_tick, peer_inputs, peer_checksum = self.last.pop(peer)
+            self.departed[peer] = (peer_tick, peer_inputs, peer_checksum, max(peer_inputs, default=peer_tick - 1) + 1)
+        self.last.update((peer, message) for peer, message in messages.items() if peer not in self.departed)
+
+        oldest = min((message[0] for message in messages.values()), default=None)
+        for peer in [peer for peer, message in self.departed.items() if oldest is None or oldest > message[3]]:
+            del self.departed[peer]
+
+        return messages | self.departed
+
+
+class LockstepRoom(Room):
+    # Room of a Lockstep match, relays the inputs of its clients through a LockstepRelay
+    def __init__(self, name, **kwargs):
+        self.relay = LockstepRelay()
+        super().__init__(name, **kwargs)
+
+    def update(self, received):
+        return self.relay.relay(received)
+
+
+class LossySocket:
+    # wraps a UDP socket and simulates a bad network on the outgoing datagrams (for local tests)
+    def __init__(self, sock, loss=0, latency=0, jitter=0):
+        self.sock = sock
+        self.loss, self.latency, self.jitter = loss, latency, jitter
+
+    def sendto(self, data, address):
+        if random.random() < self.loss:
+            return len(data)
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            timer = threading.Timer(delay, self.sock.sendto, (data, address))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.sock.sendto(data, address)
+        return len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class Channel:
+    # one UDP peer: payloads are unreliable, carry a sequence number and older ones are dropped, events are reliable
+    # and ordered, every datagram carries the events not acknowledged yet and the acknowledgement of the remote ones
+    def __init__(self, address, max_size=max_message_size):
+        self.address, self.max_size = address, max_size
+        self.sequence, self.remote_sequence = 0, 0
+        self.fragments = {}  # sequence: (count, {index: fragment data}), messages not reassembled yet
+        self.events, self.event_sequence, self.remote_event_sequence = [], 0, 0  # events is [(event_sequence, event)]
+        self.last_received = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def queue_event(self, event):
+        with self.lock:
+            self.event_sequence += 1
+            self.events.append((self.event_sequence, event))
+
+    def packets(self, payload):
+        # the datagrams of one message: a single one if it fits, otherwise fragments that the receiver reassembles
+        # (a lost fragment loses the message, like a lost datagram)
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+            message = pickle.dumps((sequence, self.remote_event_sequence, self.events, payload))
+
+        if len(message) > self.max_size:
+            raise ValueError(f"message of {len(message)} bytes exceeds the limit of {self.max_size} bytes")
+
+        if len(message) < max_datagram_size:
+            datagrams = [bytes((WHOLE,)) + message]
+        else:
+            chunk = max_datagram_size - fragment.size
+            count = -(-len(message) // chunk)
+            datagrams = [fragment.pack(FRAGMENT, sequence, index, count) + message[index * chunk:(index + 1) * chunk] for index in range(count)]
+
+        profiler.count('bytes_out', sum(len(datagram) for datagram in datagrams))
+        return datagrams
+
+    def reassemble(self, datagram):
+        # the whole message once every fragment of it arrived, None until then
+        _, sequence, index, count = fragment.unpack_from(datagram)
+        if sequence <= self.remote_sequence or index >= count or (count - 1) * (max_datagram_size - fragment.size) > self.max_size:
+            return None
+
+        expected, fragments = self.fragments.setdefault(sequence, (count, {}))
+        if count != expected:  # malformed or stray fragment
+            return None
+        fragments[index] = datagram[fragment.size:]
+        if len(fragments) < count:
+            while len(self.fragments) > 4:  # messages that lost a fragment are never completed
+                del self.fragments[min(self.fragments)]
+            return None
+
+        for old_sequence in [old_sequence for old_sequence in self.fragments if old_sequence <= sequence]:
+            del self.fragments[old_sequence]
+        return b''.join(fragments[i] for i in range(count))
+
+    def receive(self, datagram):
+        # (payload or None, events delivered), datagram is any datagram made by packets
+        profiler.count('bytes_in', len(datagram))
+        if datagram[0] == FRAGMENT:
+            message = self.reassemble(datagram)
+            if message is None:
+                return None, []
+        else:
+            message = memoryview(datagram)[1:]
+
+        sequence, event_ack, events, payload = pickle.loads(message)
+        self.last_received = time.perf_counter()
+
+        with self.lock:
+            self.events = [(event_sequence, event) for event_sequence, event in self.events if event_sequence > event_ack]
+
+            delivered = []
+            for event_sequence, event in events:
+                if event_sequence == self.remote_event_sequence + 1:  # events after a gap are sent again later
+                    self.remote_event_sequence += 1
+                    delivered.append(event)
+
+        if sequence <= self.remote_sequence:  # late or duplicated datagram: only its events and acks are used
+            return None, delivered
+        self.remote_sequence = sequence
+        return payload, delivered
+
+
+class UdpServer(Server):
+    # Server over UDP: snapshots are sent as unreliable datagrams, so a lost one never delays the next ones,
+    # send_event/get_events give a reliable and ordered channel for rare events (joins, shots, rope attaches...)
+    sock_type = socket.SOCK_DGRAM
+
+    def __init__(self, *args, timeout=5, loss=0, latency=0, jitter=0, **kwargs):
+        kwargs.setdefault('tick_rate', 30)  # lost datagrams are never resent, snapshots must keep flowing
+        self.timeout = timeout
+        self.channels, self.addresses, self.events = {}, {}, []
+        self.loss, self.latency, self.jitter = loss, latency, jitter
+        super().__init__(*args, **kwargs)
+
+    def start(self):
+        if self.loss or self.latency or self.jitter:
+            self.sock = LossySocket(self.sock, self.loss, self.latency, self.jitter)
+        print('\nSERVER: waiting for connection')
+
+        start_new_thread(self.receive_loop, ())
+        if self.tick_rate:
+            start_new_thread(self.tick_loop, ())
+
+    def receive_loop(self):
+        connection_number = 0
+
+        while True:
+            try:
+                datagram, address = self.sock.recvfrom(max_datagram_size)
+            except OSError:  # the socket was closed
+                break
+
+            if address not in self.addresses:
+                connection_number += 1
+                print(f'SERVER: connected to: {address[0]}')
+
+                self.addresses[address] = connection_number
+                self.channels[connection_number] = self.connections[connection_number] = Channel(address, self.max_size)
+                self.channels[connection_number].queue_event(('connected', connection_number))
+
+            number = self.addresses[address]
+            try:
+                payload, events = self.channels[number].receive(datagram)
+                self.events.extend((number, event) for event in events if event != 'connect')
+
+                if payload is not None:
+                    self.receive(number, payload)
+
+                # without ticks every datagram is answered: with the reply to a payload, or with the pending events
+                # and acknowledgements only (e.g. the client number answering the hello of a new client)
+                if not self.tick_rate and (payload is not None or events or self.channels[number].events):
+                    self.transmit(number, self.reply(number) if payload is not None else None)
+            except Exception as e:
+                print(f'SERVER: {e}')
+
+    def transmit(self, connection_number, payload):
+        channel = self.channels[connection_number]
+
+        if time.perf_counter() - channel.last_received > self.timeout:
+            print('SERVER: connection lost')
+            self.disconnect(connection_number)
+        else:
+            for datagram in channel.packets(payload):
+                self.sock.sendto(datagram, channel.address)
+
+    def disconnect(self, connection_number):
+        channel = self.channels.pop(connection_number, None)
+        if channel:
+            self.addresses.pop(channel.address, None)
+        self.connections.pop(connection_number, None)
+        super().disconnect(connection_number)
+
+    def send_event(self, event, connection_number=None):
+        # to one client, or to every client if connection_number is None
+        for number, channel in list(self.channels.items()):
+            if connection_number is None or number == connection_number:
+                channel.queue_event(event)
+
+    def get_events(self):
+        # [(connection_number, event)] received since the last call
+        events, self.events = self.events, []
+        return events
+
+
+class UdpClient(Client):
+    def __init__(self, *args, connect_timeout=5, loss=0, latency=0, jitter=0, **kwargs):
+        kwargs.setdefault('tick_rate', 30)  # a lost answer would block a request/response client until the timeout
+        self.connect_timeout = connect_timeout
+        self.channel, self.events = None, []
+        self.loss, self.latency, self.jitter = loss, latency, jitter
+        super().__init__(*args, **kwargs)
+
+    def connect(self, server_ip, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.loss or self.latency or self.jitter:
+            self.sock = LossySocket(self.sock, self.loss, self.latency, self.jitter)
+        self.channel = Channel((server_ip, port), self.max_size)
+        self.channel.queue_event('connect')
+
+        # say hello until the server answers with the client number
+        self.sock.settimeout(0.1)
+        end = time.perf_counter() + self.connect_timeout
+        while time.perf_counter() < end:
+            for datagram in self.channel.packets(None):
+                self.sock.sendto(datagram, self.channel.address)
+            try:
+                _, events = self.channel.receive(self.sock.recvfrom(max_datagram_size)[0])
+            except socket.timeout:
+                continue
+
+            for event in events:
+                if isinstance(event, tuple) and event[0] == 'connected':
+                    self.sock.settimeout(self.connect_timeout)
+                    return event[1]
+                self.events.append(event)
+
+        raise socket.timeout('no answer from the server')
+
+    def send_payload(self, payload):
+        for datagram in self.channel.packets(payload):
+            self.sock.sendto(datagram, self.channel.address)
+
+    def recv_payload(self):
+        while True:
+            try:
+                datagram = self.sock.recvfrom(max_datagram_size)[0]
+            except socket.timeout:
+                raise ConnectionError('no answer from the server')
+
+            payload, events = self.channel.receive(datagram)
+            self.events.extend(events)
+            if payload is not None:
+                return payload
+
+    def send_event(self, event):
+        self.channel.queue_event(event)
+        if self.pending is not None:  # flush it with the next datagram, before the first send it waits for it
+            self.new_data.set()
+
+    def get_events(self):
+        # events received since the last call
+        events, self.events = self.events, []
+        return events
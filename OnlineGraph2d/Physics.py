@@ -1,8 +1,13 @@
+import heapq
+import itertools
 import math
+from collections import deque
 from dataclasses import dataclass
 
 import pygame
 
+from OnlineGraph2d.Profiler import profiler
+
 
 @dataclass
 class Settings:
@@ -11,15 +16,314 @@ class Settings:
     air_friction: float = 0.015
     swing_friction: float = 0.0015
     rope_animation_speed: int = 40
+    continuous_collision: bool = True  # swept collision with time of impact, False for the per-axis test
+    collision_iterations: int = 4  # impacts resolved per step, the rest of the step is dropped after the last one
+
+
+entity_ids = itertools.count(1)  # 0 is reserved for 'no entity'
+contact_epsilon = 1e-6  # bodies closer than this (in pixels) are touching
+
+
+def sweep(pos, size, circle, disp, rect):
+    # time of impact in [0, 1] of the box at pos (or the circle inscribed in it) moving by disp against rect
+    # (x0, y0, x1, y1), returns (t, normal_x, normal_y) or None
+    # a body touching rect hits it at t = 0 if it moves into it, grazing contacts and bodies already inside are ignored
+    half_x, half_y = (size[0] / 2, size[0] / 2) if circle else (size[0] / 2, size[1] / 2)
+    center_x, center_y = pos[0] + size[0] / 2, pos[1] + size[1] / 2
+    disp_x, disp_y = disp
+
+    # the center against rect grown by the body
+    x0, y0, x1, y1 = rect[0] - half_x, rect[1] - half_y, rect[2] + half_x, rect[3] + half_y
+
+    entry, leave, normal, speed = -math.inf, math.inf, None, 0
+    if disp_x == 0:
+        if not x0 + contact_epsilon < center_x < x1 - contact_epsilon:
+            return None
+    else:
+        near, far = ((x0 - center_x) / disp_x, (x1 - center_x) / disp_x) if disp_x > 0 else ((x1 - center_x) / disp_x, (x0 - center_x) / disp_x)
+        entry, leave, normal, speed = near, far, (-1 if disp_x > 0 else 1, 0), abs(disp_x)
+
+    if disp_y == 0:
+        if not y0 + contact_epsilon < center_y < y1 - contact_epsilon:
+            return None
+    else:
+        near, far = ((y0 - center_y) / disp_y, (y1 - center_y) / disp_y) if disp_y > 0 else ((y1 - center_y) / disp_y, (y0 - center_y) / disp_y)
+        if near > entry:
+            entry, normal, speed = near, (0, -1 if disp_y > 0 else 1), abs(disp_y)
+        leave = min(leave, far)
+
+    if normal is None or entry >= leave or entry > 1:
+        return None
+    t = max(entry, 0)
+    hit_x, hit_y = center_x + disp_x * t, center_y + disp_y * t
+    inside = entry * speed < -contact_epsilon  # already inside the grown rect
+
+    if not circle:
+        if inside:
+            return None
+        # touching only by a corner is not an impact (e.g. the seam between two tiles of a floor)
+        if normal[0] and not y0 + contact_epsilon < hit_y < y1 - contact_epsilon:
+            return None
+        if normal[1] and not x0 + contact_epsilon < hit_x < x1 - contact_epsilon:
+            return None
+        return t, normal[0], normal[1]
+
+    # the grown rect of a circle has round corners: past the sides of rect, the circle hits the corner point
+    corner_x = rect[0] if hit_x < rect[0] else rect[2] if hit_x > rect[2] else None
+    corner_y = rect[1] if hit_y < rect[1] else rect[3] if hit_y > rect[3] else None
+    if corner_x is None or corner_y is None:
+        return None if inside else (t, normal[0], normal[1])
+
+    # ray against the circle of radius half_x around the corner
+    rel_x, rel_y = center_x - corner_x, center_y - corner_y
+    a = disp_x * disp_x + disp_y * disp_y
+    b = 2 * (rel_x * disp_x + rel_y * disp_y)
+    c = rel_x * rel_x + rel_y * rel_y - half_x * half_x
+    discriminant = b * b - 4 * a * c
+    if discriminant < 0:
+        return None
+
+    t = (-b - math.sqrt(discriminant)) / (2 * a)
+    if t > 1 or t * math.sqrt(a) < -contact_epsilon:
+        return None
+    t = max(t, 0)
+
+    normal_x, normal_y = (rel_x + disp_x * t) / half_x, (rel_y + disp_y * t) / half_x
+    if disp_x * normal_x + disp_y * normal_y >= 0:  # leaving or sliding along the corner
+        return None
+    return t, normal_x, normal_y
+
+
+class BVH:
+    # bounding volume hierarchy over static (pos, size) rects (e.g. the map collision list), built once: nearest
+    # point, raycast and region queries only visit the branches that can contain the answer, O(log n) on large maps
+    # nodes are (box, left, right, items), leaves have no children and up to leaf_size items (x0, y0, x1, y1, rect)
+    def __init__(self, rects, leaf_size=4):
+        self.leaf_size = leaf_size
+        items = [(pos[0], pos[1], pos[0] + size[0], pos[1] + size[1], (pos, size)) for pos, size in rects]
+        self.root = self.build(items) if items else None
+
+    def build(self, items):
+        box = (min(item[0] for item in items), min(item[1] for item in items), max(item[2] for item in items), max(item[3] for item in items))
+        if len(items) <= self.leaf_size:
+            return box, None, None, items
+
+        # split at the median of the longest side
+        axis = 0 if box[2] - box[0] >= box[3] - box[1] else 1
+        items.sort(key=lambda item: item[axis] + item[axis + 2])
+        half = len(items) // 2
+        return box, self.build(items[:half]), self.build(items[half:]), None
+
+    def nearest(self, point, max_distance=math.inf):
+        # closest point of the rects to point: (closest point, distance, rect) or None if nothing is within
+        # max_distance, a point inside a rect is its own closest point
+        if self.root is None:
+            return None
+
+        best, best_distance = None, max_distance * max_distance
+        order = itertools.count()  # tie breaker, nodes can't be compared
+        heap = [(box_distance(self.root[0], point), next(order), self.root)]
+
+        while heap:
+            distance, _, node = heapq.heappop(heap)
+            if distance > best_distance:
+                break
+
+            if node[3] is None:
+                for child in node[1:3]:
+                    child_distance = box_distance(child[0], point)
+                    if child_distance <= best_distance:
+                        heapq.heappush(heap, (child_distance, next(order), child))
+                continue
+
+            for x0, y0, x1, y1, rect in node[3]:
+                closest = (max(x0, min(point[0], x1)), max(y0, min(point[1], y1)))
+                distance = (closest[0] - point[0]) ** 2 + (closest[1] - point[1]) ** 2
+                if distance < best_distance or best is None and distance <= best_distance:
+                    best, best_distance = (closest, rect), distance
+                    if distance == 0:
+                        return closest, 0, rect
+
+        return None if best is None else (best[0], math.sqrt(best_distance), best[1])
+
+    def raycast(self, start, end):
+        # first rect crossed by the segment from start to end: (t in [0, 1], hit point, rect) or None,
+        # a start inside a rect hits it at t = 0
+        if self.root is None:
+            return None
+
+        delta = (end[0] - start[0], end[1] - start[1])
+        best = None
+        stack = [self.root]
+
+        while stack:
+            node = stack.pop()
+            entry = segment_box(start, delta, node[0])
+            if entry is None or (best is not None and entry >= best[0]):
+                continue
+
+            if node[3] is None:
+                stack.extend(node[1:3])
+                continue
+
+            for item in node[3]:
+                entry = segment_box(start, delta, item)
+                if entry is not None and (best is None or entry < best[0]):
+                    best = (entry, (start[0] + delta[0] * entry, start[1] + delta[1] * entry), item[4])
+
+        return best
+
+    def region(self, x0, y0, x1, y1):
+        # the rects touching the area
+        rects = []
+        stack = [self.root] if self.root else []
+
+        while stack:
+            node = stack.pop()
+            box = node[0]
+            if box[0] > x1 or box[2] < x0 or box[1] > y1 or box[3] < y0:
+                continue
+
+            if node[3] is None:
+                stack.extend(node[1:3])
+            else:
+                rects.extend(item[4] for item in node[3] if not (item[0] > x1 or item[2] < x0 or item[1] > y1 or item[3] < y0))
+
+        return rects
+
+    def __iter__(self):
+        return iter(self.region(-math.inf, -math.inf, math.inf, math.inf))
+
+
+def box_distance(box, point):
+    # squared distance from point to the box (x0, y0, x1, y1), 0 inside
+    dx = max(box[0] - point[0], 0, point[0] - box[2])
+    dy = max(box[1] - point[1], 0, point[1] - box[3])
+    return dx * dx + dy * dy
+
+
+def segment_box(start, delta, box):
+    # t in [0, 1] at which the segment start + delta * t enters the box (x0, y0, x1, y1), None if it doesn't
+    t_min, t_max = 0, 1
+    for axis in (0, 1):
+        if delta[axis] == 0:
+            if not box[axis] <= start[axis] <= box[axis + 2]:
+                return None
+            continue
+
+        t0, t1 = (box[axis] - start[axis]) / delta[axis], (box[axis + 2] - start[axis]) / delta[axis]
+        if t0 > t1:
+            t0, t1 = t1, t0
+        t_min, t_max = max(t_min, t0), min(t_max, t1)
+        if t_min > t_max:
+            return None
+
+    return t_min
+
+
+class EntityRegistry:
+    # entities by their entity_id: O(1) add, remove and lookup, iteration in insertion order
+    # the ids are given once by Object and never reused, so they can be sent over the network to reference an entity
+    def __init__(self, entities=()):
+        self.entities = {}
+        for obj in entities:
+            self.add(obj)
+
+    def add(self, obj):
+        self.entities[obj.entity_id] = obj
+        return obj
+
+    def remove(self, obj):
+        # obj can also be an entity_id, missing entities are ignored
+        self.entities.pop(getattr(obj, 'entity_id', obj), None)
+
+    def get(self, entity_id, default=None):
+        return self.entities.get(entity_id, default)
+
+    def values(self):
+        return self.entities.values()
+
+    def __contains__(self, obj):
+        return getattr(obj, 'entity_id', obj) in self.entities
+
+    def __iter__(self):
+        return iter(self.entities.values())
+
+    def __len__(self):
+        return len(self.entities)
+
+
+class SpatialHash:
+    # uniform grid broadphase over (pos, size) rects: static geometry is inserted once, moving rects are kept up to
+    # date with move, query only returns the rects in the cells touched by the queried area
+    def __init__(self, cell_size=128):
+        self.cell_size = cell_size
+        self.cells = {}  # (cell_x, cell_y): {key}
+        self.entries = {}  # key: (pos, size, cells)
+
+    def cell_range(self, x0, y0, x1, y1):
+        return (int(x0 // self.cell_size), int(y0 // self.cell_size), int(x1 // self.cell_size), int(y1 // self.cell_size))
+
+    def insert(self, key, pos, size):
+        if key in self.entries:
+            self.remove(key)
+
+        cells = self.cell_range(pos[0], pos[1], pos[0] + size[0], pos[1] + size[1])
+        for cell_x in range(cells[0], cells[2] + 1):
+            for cell_y in range(cells[1], cells[3] + 1):
+                self.cells.setdefault((cell_x, cell_y), set()).add(key)
+
+        self.entries[key] = (pos, size, cells)
+
+    def remove(self, key):
+        _, _, cells = self.entries.pop(key)
+        for cell_x in range(cells[0], cells[2] + 1):
+            for cell_y in range(cells[1], cells[3] + 1):
+                cell = self.cells[(cell_x, cell_y)]
+                cell.discard(key)
+                if not cell:
+                    del self.cells[(cell_x, cell_y)]
+
+    def move(self, key, pos, size):
+        entry = self.entries.get(key)
+        if entry is None or entry[2] != self.cell_range(pos[0], pos[1], pos[0] + size[0], pos[1] + size[1]):
+            self.insert(key, pos, size)
+        elif entry[0] is not pos or entry[1] is not size:
+            self.entries[key] = (pos, size, entry[2])  # same cells, only the references changed
+
+    def query(self, x0, y0, x1, y1):
+        cells = self.cell_range(x0, y0, x1, y1)
+        keys = set()
+        for cell_x in range(cells[0], cells[2] + 1):
+            for cell_y in range(cells[1], cells[3] + 1):
+                keys.update(self.cells.get((cell_x, cell_y), ()))
+
+        return [self.entries[key][:2] for key in keys]
+
+    def keys(self):
+        return self.entries.keys()
+
+    def __iter__(self):
+        return (entry[:2] for entry in self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
 
 
 class Object:
+    # __slots__ keep the entities small and their attributes fast, subclasses without __slots__ (e.g. a game's own
+    # objects) get a __dict__ back for their extra attributes
+    __slots__ = ('entity_id', 'pos', 'angle', 'size', 'shape', 'color', 'layer', 'centered', 'show')
+
     def __init__(self, pos, angle, size, shape, color, layer, centered=False, show=True):
+        self.entity_id = next(entity_ids)
         self.pos, self.angle, self.size = pos, angle, size
         self.shape, self.color, self.layer, self.centered, self.show = shape, color, layer, centered, show
 
 
 class GameObject(Object):
+    __slots__ = ('static', 'rope', 'mass', 'collision', 'touching', 'can_jump', 'vel', 'acc', 'ang_vel', 'ang_acc')
+
     def __init__(self, static, mass=None, collision=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.static = static
@@ -38,6 +342,9 @@ class GameObject(Object):
 
     def update(self):
         if not self.static:
+            if self.rope:
+                self.rope.advance()
+
             # add acceleration
             self.vel[0] += self.acc[0]
             self.vel[1] += self.acc[1]
@@ -86,29 +393,128 @@ class GameObject(Object):
             # check game map collision
             self.touching, self.can_jump = False, False
 
-            for map_obj in self.collision:  # map_obj is [pos[x, y], size[x, y]] of type tuple[tuple[int, int], tuple[int, int]]
-                obj_x_edge = (map_obj[0][0], map_obj[0][0] + map_obj[1][0])
-                obj_y_edge = (map_obj[0][1], map_obj[0][1] + map_obj[1][1])
+            if isinstance(self.collision, SpatialHash) and Settings.continuous_collision:
+                # the slides of move_swept can turn the velocity but never speed it up: every direction within speed
+                speed = math.hypot(self.vel[0], self.vel[1])
+                candidates = self.collision.query(x_edge[0] - speed, y_edge[0] - speed, x_edge[1] + speed, y_edge[1] + speed)
+            elif isinstance(self.collision, SpatialHash):  # only the rects the object can reach in this step
+                candidates = self.collision.query(x_edge[0] + min(self.vel[0], 0), y_edge[0] + min(self.vel[1], 0), x_edge[1] + max(self.vel[0], 0), y_edge[1] + max(self.vel[1], 0))
+            else:
+                candidates = self.collision
 
-                if y_edge[0] < obj_y_edge[1] and y_edge[1] > obj_y_edge[0]:  # they are aligned on the y_axis
-                    if (self.vel[0] > 0 and x_edge[1] < obj_x_edge[0] < (x_edge[1] + self.vel[0])) or (self.vel[0] < 0 and x_edge[0] > obj_x_edge[1] > (x_edge[0] + self.vel[0])):  # they will collide on the x-axis
-                        self.touching = True
-                        self.vel[0] = 0
+            if profiler.enabled:
+                profiler.count('collisions_tested', len(candidates))
 
-                if x_edge[0] < obj_x_edge[1] and x_edge[1] > obj_x_edge[0]:  # they are aligned on the y_axis
-                    if (self.vel[1] > 0 and y_edge[1] < obj_y_edge[0] < (y_edge[1] + self.vel[1])) or (self.vel[1] < 0 and y_edge[0] > obj_y_edge[1] > (y_edge[0] + self.vel[1])):  # they will collide on the y-axis
-                        self.touching = True
-                        if self.vel[1] > 0:  # if it is above the object (it is going from top to bottom) it can jump
-                            self.can_jump = True
-                        self.vel[1] = 0
+            if Settings.continuous_collision:
+                self.move_swept(candidates)
+            else:
+                self.move_per_axis(candidates, x_edge, y_edge)
 
-            self.pos[0] += self.vel[0]
-            self.pos[1] += self.vel[1]
             if self.rope and self.rope.swing and self.rope.ready and not self.can_jump:
                 self.rope.angle += self.ang_vel  # update angle only if also the position is updated
         else:
             raise Exception("'update' function was called but object is static")
 
+    def move_swept(self, candidates):
+        # moves to the first impact, removes the velocity into the surface and slides for the rest of the step
+        if not candidates:
+            self.pos[0] += self.vel[0]
+            self.pos[1] += self.vel[1]
+            return
+
+        rects = [(map_obj[0][0], map_obj[0][1], map_obj[0][0] + map_obj[1][0], map_obj[0][1] + map_obj[1][1]) for map_obj in candidates]
+        circle = self.shape == 'circle'
+        remaining = 1
+
+        for _ in range(Settings.collision_iterations):
+            disp = (self.vel[0] * remaining, self.vel[1] * remaining)
+            if disp[0] == 0 and disp[1] == 0:
+                return
+
+            # only the rects touching the area swept in this iteration
+            x0, x1 = (self.pos[0], self.pos[0] + self.size[0] + disp[0]) if disp[0] > 0 else (self.pos[0] + disp[0], self.pos[0] + self.size[0])
+            y0, y1 = (self.pos[1], self.pos[1] + self.size[1] + disp[1]) if disp[1] > 0 else (self.pos[1] + disp[1], self.pos[1] + self.size[1])
+
+            impact = None
+            for rect in rects:
+                if rect[0] > x1 or rect[2] < x0 or rect[1] > y1 or rect[3] < y0:
+                    continue
+                hit = sweep(self.pos, self.size, circle, disp, rect)
+                if hit and (impact is None or hit[0] < impact[0]):
+                    impact = hit
+
+            if impact is None:
+                self.pos[0] += disp[0]
+                self.pos[1] += disp[1]
+                return
+
+            t, normal_x, normal_y = impact
+            self.pos[0] += disp[0] * t
+            self.pos[1] += disp[1] * t
+            remaining *= 1 - t
+
+            into = self.vel[0] * normal_x + self.vel[1] * normal_y
+            self.vel[0] -= into * normal_x
+            self.vel[1] -= into * normal_y
+
+            self.touching = True
+            if normal_y < -0.5:  # standing on something not steeper than 60°
+                self.can_jump = True
+
+    def move_per_axis(self, candidates, x_edge, y_edge):
+        # the axes are tested separately from the position at the start of the step, fast objects can go through
+        # corners and they stop short of the surface
+        for map_obj in candidates:  # map_obj is [pos[x, y], size[x, y]] of type tuple[tuple[int, int], tuple[int, int]]
+            obj_x_edge = (map_obj[0][0], map_obj[0][0] + map_obj[1][0])
+            obj_y_edge = (map_obj[0][1], map_obj[0][1] + map_obj[1][1])
+
+            if y_edge[0] < obj_y_edge[1] and y_edge[1] > obj_y_edge[0]:  # they are aligned on the y_axis
+                if (self.vel[0] > 0 and x_edge[1] < obj_x_edge[0] < (x_edge[1] + self.vel[0])) or (self.vel[0] < 0 and x_edge[0] > obj_x_edge[1] > (x_edge[0] + self.vel[0])):  # they will collide on the x-axis
+                    self.touching = True
+                    self.vel[0] = 0
+
+            if x_edge[0] < obj_x_edge[1] and x_edge[1] > obj_x_edge[0]:  # they are aligned on the y_axis
+                if (self.vel[1] > 0 and y_edge[1] < obj_y_edge[0] < (y_edge[1] + self.vel[1])) or (self.vel[1] < 0 and y_edge[0] > obj_y_edge[1] > (y_edge[0] + self.vel[1])):  # they will collide on the y-axis
+                    self.touching = True
+                    if self.vel[1] > 0:  # if it is above the object (it is going from top to bottom) it can jump
+                        self.can_jump = True
+                    self.vel[1] = 0
+
+        self.pos[0] += self.vel[0]
+        self.pos[1] += self.vel[1]
+
+    def get_state(self):
+        # everything update changes, used to rewind the object (see Predictor), plain data that can be sent to another
+        # process: the rope is (pivot, swing, angle, length, init_vel, ready, animation_steps, animation_pos), init_vel
+        # is True while it is the object's own velocity (read when the rope gets ready)
+        rope_state = None
+        if self.rope:
+            rope = self.rope
+            init_vel = True if rope.init_vel is self.vel else tuple(rope.init_vel) if rope.init_vel is not None else None
+            rope_state = (tuple(rope.pivot), rope.swing, rope.angle, rope.length, init_vel, rope.ready, rope.animation_steps, tuple(rope.animation_pos))
+        return tuple(self.pos), tuple(self.vel), self.touching, self.can_jump, self.ang_vel, self.ang_acc, rope_state
+
+    def set_state(self, state):
+        pos, vel, self.touching, self.can_jump, self.ang_vel, self.ang_acc, rope_state = state
+        self.pos[0], self.pos[1] = pos
+        self.vel[0], self.vel[1] = vel
+
+        if rope_state:
+            pivot, swing, angle, length, init_vel, ready, animation_steps, animation_pos = rope_state
+            if not self.rope or self.rope.obj is not self:  # e.g. the rope was attached on the authority only
+                self.rope = Rope.__new__(Rope)  # skip __init__, every field is set below
+                self.rope.obj, self.rope.pivot, self.rope.animation_pos = self, list(pivot), [0, 0]
+                self.rope.color, self.rope.show = self.color, True
+            elif tuple(self.rope.pivot) != pivot:  # the pivot can be shared with another object (e.g. an aim dot)
+                self.rope.pivot = list(pivot)
+
+            self.rope.swing, self.rope.angle, self.rope.length = swing, angle, length
+            self.rope.init_vel = self.vel if init_vel is True else init_vel
+            self.rope.ready, self.rope.animation_steps = ready, animation_steps
+            self.rope.animation_pos[0], self.rope.animation_pos[1] = animation_pos
+        else:
+            self.rope = None
+
     def apply_vel(self, vel, angle):
         if vel is not None and angle is not None:
             vel_x = vel * math.cos(angle)
@@ -146,7 +552,78 @@ class GameObject(Object):
             pygame.draw.line(display, (255, 0, 0), central_pos, (central_pos[0] + self.vel[0] * 10, central_pos[1] + self.vel[1] * 10), width=3)
 
 
+class Projectile(GameObject):
+    __slots__ = ('expires',)  # frame of the pool at which it expires
+
+
+class ProjectilePool:
+    # preallocated, reusable projectiles: spawn takes a free one (or recycles the oldest one in flight when all are
+    # used), update steps every projectile in flight and frees the ones past their lifetime (in frames) or out of
+    # bounds (x0, y0, x1, y1), nothing is allocated per shot
+    # each spawn gets a new entity_id so that remote hosts don't blend a recycled projectile with its previous flight
+    def __init__(self, capacity, lifetime=None, bounds=None, entities=None, collision=None, mass=0.1, size=(5, 5), shape='circle', color=(255, 255, 255), layer=10):
+        if capacity < 1:
+            raise ValueError("'capacity' must be at least 1")
+
+        self.lifetime, self.bounds = lifetime, bounds
+        self.entities = entities  # EntityRegistry the projectiles in flight are added to
+        self.frame = 0
+
+        self.free = [Projectile(static=False, pos=[0, 0], angle=0, size=size, shape=shape, color=color, layer=layer, mass=mass, collision=collision) for _ in range(capacity)]
+        self.active = deque()  # oldest first
+
+    def spawn(self, pos, vel, angle):
+        if self.free:
+            projectile = self.free.pop()
+        else:
+            projectile = self.active.popleft()
+            if self.entities is not None:
+                self.entities.remove(projectile)
+
+        projectile.entity_id = next(entity_ids)
+        projectile.pos[0], projectile.pos[1] = pos[0], pos[1]
+        projectile.vel[0], projectile.vel[1] = 0, 0
+        projectile.touching, projectile.can_jump, projectile.rope = False, False, None
+        projectile.apply_vel(vel=vel, angle=angle)
+        projectile.expires = self.frame + self.lifetime if self.lifetime is not None else None
+
+        self.active.append(projectile)
+        if self.entities is not None:
+            self.entities.add(projectile)
+        return projectile
+
+    def update(self):
+        self.frame += 1
+
+        # the projectiles still in flight are rotated back to the end of the deque, in order
+        for _ in range(len(self.active)):
+            projectile = self.active.popleft()
+            projectile.update()
+
+            if (projectile.expires is not None and self.frame >= projectile.expires) or (self.bounds and not (self.bounds[0] <= projectile.pos[0] <= self.bounds[2] and self.bounds[1] <= projectile.pos[1] <= self.bounds[3])):
+                self.free.append(projectile)
+                if self.entities is not None:
+                    self.entities.remove(projectile)
+            else:
+                self.active.append(projectile)
+
+    def clear(self):
+        for projectile in self.active:
+            if self.entities is not None:
+                self.entities.remove(projectile)
+        self.free.extend(self.active)
+        self.active.clear()
+
+    def __iter__(self):
+        return iter(self.active)
+
+    def __len__(self):
+        return len(self.active)
+
+
 class FollowerObject(Object):
+    __slots__ = ('obj', 'rel_pos')
+
     def __init__(self, obj, rel_pos, *args, **kwargs):
         super().__init__(pos=[0, 0], *args, **kwargs)
         self.obj = obj
@@ -173,6 +650,8 @@ class Camera:
 
 
 class Rope:
+    __slots__ = ('obj', 'pivot', 'init_vel', 'swing', 'color', 'show', 'ready', 'animation_steps', 'animation_pos', 'length', 'angle')
+
     def __init__(self, obj, pivot, init_vel, swing, color, show=True):
         self.obj, self.pivot, self.init_vel = obj, pivot, init_vel
         self.swing = swing
@@ -193,7 +672,9 @@ class Rope:
         self.animation_pos[1] = self.obj.pos[1] + self.obj.size[1] / 2 - Settings.rope_animation_speed * self.animation_steps * math.cos(self.angle)
         self.animation_steps += 1
 
-    def blit(self, display, camera):
+    def advance(self):
+        # one step of the attach animation, run by the update of the object (the rope is used once it is ready), so
+        # that it depends on the physics steps and not on the frames drawn
         if not self.ready:
             self.ready = abs(self.pivot[0] - self.animation_pos[0]) <= abs(Settings.rope_animation_speed * math.sin(self.angle))
 
@@ -201,6 +682,86 @@ class Rope:
             self.update()
             self.update_animation()
 
-            pygame.draw.line(display, self.color, (self.obj.pos[0] + self.obj.size[0] / 2 - camera.pos[0], self.obj.pos[1] + self.obj.size[1] / 2 - camera.pos[1]), (self.animation_pos[0] - camera.pos[0], self.animation_pos[1] - camera.pos[1]), width=2)
+    def line(self, camera):
+        # on-screen start and end of the rope
+        start = (self.obj.pos[0] + self.obj.size[0] / 2 - camera.pos[0], self.obj.pos[1] + self.obj.size[1] / 2 - camera.pos[1])
+
+        if not self.ready:
+            return start, (self.animation_pos[0] - camera.pos[0], self.animation_pos[1] - camera.pos[1])
         else:
-            pygame.draw.line(display, self.color, (self.obj.pos[0] + self.obj.size[0] / 2 - camera.pos[0], self.obj.pos[1] + self.obj.size[1] / 2 - camera.pos[1]), (self.pivot[0] - camera.pos[0], self.pivot[1] - camera.pos[1]), width=2)
+            return start, (self.pivot[0] - camera.pos[0], self.pivot[1] - camera.pos[1])
+
+    def blit(self, display, camera):
+        pygame.draw.line(display, self.color, *self.line(camera), width=2)
+
+
+class Predictor:
+    # client-side prediction for a locally controlled GameObject: every input is applied immediately and remembered
+    # until the authority acknowledges it, a correction rewinds the object and replays the inputs not yet acknowledged
+    def __init__(self, obj, apply_input, history=256, tolerance=0.01):
+        self.obj = obj
+        self.apply_input = apply_input  # apply_input(obj, player_input) applies one frame of input before the update
+        self.tolerance = tolerance
+        self.sequence = 0
+        self.inputs = deque(maxlen=history)  # (sequence, input, predicted state after the update)
+
+    def step(self, player_input):
+        self.sequence += 1
+        self.apply_input(self.obj, player_input)
+        self.obj.update()
+        self.inputs.append((self.sequence, player_input, self.obj.get_state()))
+        return self.sequence  # to be sent along with the input so that the authority can acknowledge it
+
+    def reconcile(self, sequence, state):
+        # state is the authoritative result of the input number sequence
+        predicted = None
+        while self.inputs and self.inputs[0][0] <= sequence:
+            predicted = self.inputs.popleft()[2]
+
+        if predicted is not None and self.matches(predicted, state):
+            return False
+
+        self.obj.set_state(state)
+        for i, (input_sequence, player_input, _) in enumerate(self.inputs):
+            self.apply_input(self.obj, player_input)
+            self.obj.update()
+            self.inputs[i] = (input_sequence, player_input, self.obj.get_state())
+        return True
+
+    def matches(self, predicted, state):
+        if not (all(abs(a - b) <= self.tolerance for a, b in zip(predicted[0] + predicted[1], state[0] + state[1])) and predicted[2:4] == state[2:4]):
+            return False
+
+        rope, state_rope = predicted[6], state[6]
+        if rope is None or state_rope is None:
+            return rope is state_rope
+        # pivot, angle and length within tolerance, the same swing and attach state
+        return rope[1] == state_rope[1] and rope[5] == state_rope[5] and all(abs(a - b) <= self.tolerance for a, b in zip(rope[0] + rope[2:4], state_rope[0] + state_rope[2:4]))
+
+
+class FixedStep:
+    # runs step() at a fixed rate whatever the frame rate: call advance(elapsed) once per frame with the seconds
+    # elapsed since the previous frame, the time left over is carried to the next frame
+    # the physics settings are per step, so with a fixed rate the game runs at the same speed on every machine and
+    # the same inputs give the same steps (see Network.Lockstep)
+    # at most max_steps are run per frame, the time beyond is dropped so that a slow frame doesn't snowball
+    def __init__(self, step, rate=120, max_steps=8):
+        self.step, self.dt, self.max_steps = step, 1 / rate, max_steps
+        self.accumulator = 0  # time not simulated yet
+        self.steps = 0  # steps run so far
+
+    def advance(self, elapsed):
+        # returns the number of steps run
+        self.accumulator += elapsed
+
+        steps = 0
+        while self.accumulator >= self.dt and steps < self.max_steps:
+            self.step()
+            self.accumulator -= self.dt
+            steps += 1
+
+        if self.accumulator >= self.dt:  # too far behind
+            self.accumulator %= self.dt
+
+        self.steps += steps
+        return steps
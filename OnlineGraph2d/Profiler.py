@@ -0,0 +1,120 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class NullSpan:
+    # returned by Profiler.span while the profiler is disabled, so that a disabled span costs one call
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Span:
+    def __init__(self, profiler, name):
+        self.profiler, self.name = profiler, name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add_time(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Profiler:
+    # named spans (time per frame) and counters (value per frame), averaged over the last window frames,
+    # spans can also be recorded as a Chrome trace (chrome://tracing or https://ui.perfetto.dev)
+    # usage: with profiler.span('physics'): ..., profiler.count('bytes_out', n), profiler.frame() once per frame
+    # counters in hot loops should be guarded with `if profiler.enabled:`
+    def __init__(self, window=120, max_events=200000):
+        self.enabled, self.tracing = False, False
+        self.window, self.max_events = window, max_events
+        self.times, self.counters = {}, {}  # current frame
+        self.history = deque(maxlen=window)  # (times, counters) of the last frames
+        self.events = []
+        self.lock = threading.Lock()  # spans and counters can come from the network threads
+
+    def enable(self, tracing=False):
+        self.enabled, self.tracing = True, tracing
+
+    def disable(self):
+        self.enabled, self.tracing = False, False
+
+    def span(self, name):
+        return Span(self, name) if self.enabled else null_span
+
+    def add_time(self, name, start, end):
+        with self.lock:
+            self.times[name] = self.times.get(name, 0) + end - start
+            if self.tracing and len(self.events) < self.max_events:
+                self.events.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6, 'pid': os.getpid(), 'tid': threading.get_ident()})
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def frame(self):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if self.tracing and self.counters and len(self.events) < self.max_events:
+                self.events.append({'name': 'counters', 'ph': 'C', 'ts': time.perf_counter() * 1e6, 'pid': os.getpid(), 'args': dict(self.counters)})
+            self.history.append((self.times, self.counters))
+            self.times, self.counters = {}, {}
+
+    def stats(self):
+        # {name: (mean per frame, max per frame)} over the rolling window, span times are in milliseconds
+        with self.lock:
+            history = list(self.history)
+
+        stats = {}
+        for index, scale in ((0, 1000), (1, 1)):
+            names = {name for frame in history for name in frame[index]}
+            for name in sorted(names):
+                values = [frame[index].get(name, 0) * scale for frame in history]
+                stats[name] = (sum(values) / len(values), max(values))
+        return stats
+
+    def overlay(self, display, font, pos, color=(255, 255, 255), blit=None):
+        # draws the rolling stats with blit(image, pos) (display.blit by default), returns the rects drawn
+        blit = blit or display.blit
+        rects = []
+        x, y = pos
+        for name, (mean, peak) in self.stats().items():
+            rects.append(blit(font.render(f'{name}: {mean:.2f} (max {peak:.2f})', 1, color), (x, y)))
+            y += font.get_linesize()
+        return rects
+
+    def dump_trace(self, path):
+        with self.lock:
+            events, self.events = self.events, []
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+profiler = Profiler()  # shared by the whole library
+
+
+def profiled(name):
+    # decorator: the calls of the function are a span
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with Span(profiler, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
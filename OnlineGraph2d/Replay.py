@@ -0,0 +1,161 @@
+import mmap
+import pickle
+import struct
+import threading
+import time
+
+from OnlineGraph2d.Network import diff_snapshots, patch_snapshot
+
+# file layout: header, one record per tick, then the index written by Recorder.close
+# header: magic, version, keyframe_interval
+# record: tick, kind, time since the start of the recording, payload size, then the pickled (snapshot or delta, inputs)
+# inputs: [(client_number, data)] of the messages received since the previous record, in order
+# index: the offset of every record, followed by the footer: index offset, record count, magic
+header = struct.Struct('!4sBI')
+record_header = struct.Struct('!IBdI')
+footer = struct.Struct('!QI4s')
+magic, index_magic, version = b'OG2R', b'OG2I', 2
+
+KEYFRAME, DELTA, FULL = 0, 1, 2  # FULL: the data is not a snapshot dict, every tick is stored as it is
+
+
+class Recorder:
+    # appends every tick of a match to a file: what the server sent (delta snapshots, with a keyframe every
+    # keyframe_interval ticks) and every message it received from the clients during the tick, once, see
+    # Server(recorder=...) and Replay
+    def __init__(self, path, keyframe_interval=60):
+        self.file = open(path, 'wb')
+        self.keyframe_interval = keyframe_interval
+        self.file.write(header.pack(magic, version, keyframe_interval))
+
+        self.tick, self.offsets = 0, []
+        self.previous = None  # last snapshot recorded, the baseline of the next delta
+        self.start = time.perf_counter()
+
+        self.received = []  # [(client_number, data)] since the last record
+        self.lock = threading.Lock()  # record_input is called by the connection threads
+
+    def record_input(self, client_number, data):
+        with self.lock:
+            self.received.append((client_number, data))
+
+    def record(self, data):
+        with self.lock:
+            inputs, self.received = self.received, []
+
+        if not isinstance(data, dict):
+            kind, payload, self.previous = FULL, data, None
+        elif self.previous is None or self.tick % self.keyframe_interval == 0:
+            kind, payload, self.previous = KEYFRAME, data, dict(data)
+        else:
+            kind, payload = DELTA, diff_snapshots(self.previous, data)
+            self.previous = dict(data)
+
+        payload = pickle.dumps((payload, inputs))
+        self.offsets.append(self.file.tell())
+        self.file.write(record_header.pack(self.tick, kind, time.perf_counter() - self.start, len(payload)))
+        self.file.write(payload)
+        self.tick += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        index_offset = self.file.tell()
+        self.file.write(struct.pack(f'!{len(self.offsets)}Q', *self.offsets))
+        self.file.write(footer.pack(index_offset, len(self.offsets), index_magic))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class Replay:
+    # reads a recording through mmap, snapshot(tick) decodes from the keyframe before tick, so a seek costs at most
+    # keyframe_interval deltas whatever the length of the match, reading the ticks in order applies one delta per tick
+    # recordings that were not closed (e.g. the server crashed) are indexed by scanning them
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        file_magic, file_version, self.keyframe_interval = header.unpack_from(self.data, 0)
+        if file_magic != magic or file_version != version:
+            raise Exception(f"'{path}' is not a recording")
+
+        self.offsets = self.read_index()
+        self.tick, self.current = None, None  # last snapshot decoded by snapshot()
+
+    def read_index(self):
+        if len(self.data) >= header.size + footer.size:
+            index_offset, count, file_magic = footer.unpack_from(self.data, len(self.data) - footer.size)
+            if file_magic == index_magic:
+                return list(struct.unpack_from(f'!{count}Q', self.data, index_offset))
+
+        offsets, offset = [], header.size
+        while offset + record_header.size <= len(self.data):
+            size = record_header.unpack_from(self.data, offset)[3]
+            if offset + record_header.size + size > len(self.data):  # the last record was cut
+                break
+            offsets.append(offset)
+            offset += record_header.size + size
+        return offsets
+
+    def read(self, tick):
+        # (kind, time, payload, inputs) of a record
+        offset = self.offsets[tick]
+        _, kind, record_time, size = record_header.unpack_from(self.data, offset)
+        start = offset + record_header.size
+        payload, inputs = pickle.loads(self.data[start:start + size])
+        return kind, record_time, payload, inputs
+
+    def kind(self, tick):
+        return record_header.unpack_from(self.data, self.offsets[tick])[1]
+
+    def time(self, tick):
+        return record_header.unpack_from(self.data, self.offsets[tick])[2]
+
+    def inputs(self, tick):
+        # [(client_number, data)] received during tick
+        return self.read(tick)[3]
+
+    def snapshot(self, tick):
+        # from the last snapshot decoded if tick is after it, otherwise from the keyframe before tick
+        start = tick
+        while self.kind(start) == DELTA and start != self.tick:
+            start -= 1
+        if start != self.tick:
+            self.tick, self.current = start, self.read(start)[2]
+
+        for next_tick in range(self.tick + 1, tick + 1):
+            self.current = patch_snapshot(self.current, *self.read(next_tick)[2])
+        self.tick = tick
+        return self.current
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        # (tick, time, snapshot, inputs) in order, each record is read once
+        snapshot = None
+        for tick in range(len(self.offsets)):
+            kind, record_time, payload, inputs = self.read(tick)
+            snapshot = patch_snapshot(snapshot, *payload) if kind == DELTA else payload
+            yield tick, record_time, snapshot, inputs
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,263 @@
+import numpy as np
+
+from OnlineGraph2d.Physics import Settings, contact_epsilon
+from OnlineGraph2d.Profiler import profiled
+
+
+class PhysicsWorld:
+    # steps every dynamic GameObject added to it in one vectorized pass with the same rules as GameObject.update
+    # (swept or per-axis collision, following Settings.continuous_collision), against the rects given to
+    # set_colliders (the objects' own collision lists are not used, bodies on a rope are updated one by one against
+    # the same rects)
+    # once added, obj.pos, obj.vel and obj.acc are views into the world arrays: change them in place
+    # (obj.vel[:] = 0, 0), assigning a new list detaches them from the world
+    def __init__(self, collision=(), capacity=64, chunk_cells=1 << 20):
+        self.bodies = []
+        self.index = {}  # id(obj): row
+        self.chunk_cells = chunk_cells  # bodies x colliders tested at once, bounds the temporary arrays
+
+        self.pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.acc = np.zeros((capacity, 2))
+        self.size = np.zeros((capacity, 2))
+        self.mass = np.zeros(capacity)
+        self.touching = np.zeros(capacity, dtype=bool)
+        self.can_jump = np.zeros(capacity, dtype=bool)
+        self.circle = np.zeros(capacity, dtype=bool)
+
+        self.collision, self.colliders = [], np.zeros((0, 4))
+        self.set_colliders(collision)
+
+    def set_colliders(self, collision):
+        # collision is any iterable of (pos, size), e.g. the map collision list or a SpatialHash: the world keeps a
+        # copy of the rects, the same for every body (the ones on a rope too), call it again when they change
+        self.collision = [(tuple(pos), tuple(size)) for pos, size in collision]  # for the bodies on a rope
+        rects = [(pos[0], pos[1], pos[0] + size[0], pos[1] + size[1]) for pos, size in self.collision]
+        self.colliders = np.array(rects, dtype=float).reshape(-1, 4)
+
+    def add(self, obj):
+        if obj.static:
+            raise Exception("static objects can't be added to a PhysicsWorld")
+
+        row = len(self.bodies)
+        if row == len(self.pos):
+            self.grow()
+
+        self.pos[row], self.vel[row], self.acc[row] = obj.pos, obj.vel, obj.acc
+        self.size[row], self.mass[row] = obj.size, obj.mass
+        self.touching[row], self.can_jump[row] = obj.touching, obj.can_jump
+        self.circle[row] = obj.shape == 'circle'
+
+        self.bodies.append(obj)
+        self.index[id(obj)] = row
+        self.bind(row)
+
+    def remove(self, obj):
+        row = self.index.pop(id(obj))
+        last = len(self.bodies) - 1
+
+        # detach the object with copies of its values
+        obj.pos, obj.vel, obj.acc = self.pos[row].tolist(), self.vel[row].tolist(), self.acc[row].tolist()
+
+        # move the last body in the free row
+        if row != last:
+            for array in (self.pos, self.vel, self.acc, self.size, self.mass, self.touching, self.can_jump, self.circle):
+                array[row] = array[last]
+            self.bodies[row] = self.bodies[last]
+            self.index[id(self.bodies[row])] = row
+            self.bind(row)
+        self.bodies.pop()
+
+    def grow(self):
+        capacity = len(self.pos) * 2
+        for name in ('pos', 'vel', 'acc', 'size', 'mass', 'touching', 'can_jump', 'circle'):
+            array = getattr(self, name)
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+        for row in range(len(self.bodies)):  # the old views point to the old arrays
+            self.bind(row)
+
+    def bind(self, row):
+        obj = self.bodies[row]
+        obj.pos, obj.vel, obj.acc = self.pos[row], self.vel[row], self.acc[row]
+
+    @profiled('physics_world')
+    def step(self):
+        count = len(self.bodies)
+        if not count:
+            return
+
+        # bodies on a rope follow the pendulum rules, they are updated one by one with GameObject.update
+        roped = [row for row, obj in enumerate(self.bodies) if obj.rope]
+        active = np.ones(count, dtype=bool)
+        active[roped] = False
+        for row in roped:
+            obj = self.bodies[row]
+            obj.touching, obj.can_jump = bool(self.touching[row]), bool(self.can_jump[row])
+            collision, obj.collision = obj.collision, self.collision  # against the world's rects like the others
+            obj.update()
+            obj.collision = collision
+            self.touching[row], self.can_jump[row] = obj.touching, obj.can_jump
+
+        rows = np.flatnonzero(active)
+        pos, vel, size = self.pos[rows], self.vel[rows], self.size[rows]
+
+        # add acceleration
+        vel += self.acc[rows]
+
+        # friction
+        friction = np.where(self.touching[rows], Settings.ground_friction, Settings.air_friction) * self.mass[rows]
+        vel[:, 0] = np.where(np.abs(vel[:, 0]) <= friction, 0, vel[:, 0] - np.sign(vel[:, 0]) * friction)
+
+        if Settings.continuous_collision:
+            touching, can_jump = self.move_swept(pos, vel, size, self.circle[rows])
+        else:
+            touching, can_jump = self.move_per_axis(pos, vel, size)
+
+        self.pos[rows], self.vel[rows] = pos, vel
+        self.touching[rows], self.can_jump[rows] = touching, can_jump
+
+        for row, body_touching, body_can_jump in zip(rows.tolist(), touching.tolist(), can_jump.tolist()):
+            self.bodies[row].touching, self.bodies[row].can_jump = body_touching, body_can_jump
+
+    def move_per_axis(self, pos, vel, size):
+        # the per-axis tests of GameObject.move_per_axis, for every pair of body and collider, in chunks of bodies
+        # to bound the bodies x colliders arrays
+        touching, can_jump = np.zeros(len(pos), dtype=bool), np.zeros(len(pos), dtype=bool)
+        if len(self.colliders):
+            chunk = max(1, self.chunk_cells // len(self.colliders))
+            cx0, cy0, cx1, cy1 = (self.colliders[:, i] for i in range(4))
+
+            for start in range(0, len(pos), chunk):
+                part = slice(start, start + chunk)
+                x0, y0 = pos[part, 0:1], pos[part, 1:2]
+                x1, y1 = x0 + size[part, 0:1], y0 + size[part, 1:2]
+                vx, vy = vel[part, 0:1], vel[part, 1:2]
+
+                hit_x = (y0 < cy1) & (y1 > cy0) & (((vx > 0) & (x1 < cx0) & (cx0 < x1 + vx)) | ((vx < 0) & (x0 > cx1) & (cx1 > x0 + vx)))
+                hit_y = (x0 < cx1) & (x1 > cx0) & (((vy > 0) & (y1 < cy0) & (cy0 < y1 + vy)) | ((vy < 0) & (y0 > cy1) & (cy1 > y0 + vy)))
+                hit_x, hit_y = hit_x.any(axis=1), hit_y.any(axis=1)
+
+                touching[part] = hit_x | hit_y
+                can_jump[part] = hit_y & (vel[part, 1] > 0)
+                vel[part, 0][hit_x] = 0
+                vel[part, 1][hit_y] = 0
+
+        pos += vel
+        return touching, can_jump
+
+    def move_swept(self, pos, vel, size, circle):
+        # the rules of GameObject.move_swept for every body at once: each iteration moves the bodies to their first
+        # impact, removes the velocity into the surface and keeps the rest of the step for the next iteration
+        touching, can_jump = np.zeros(len(pos), dtype=bool), np.zeros(len(pos), dtype=bool)
+        remaining = np.ones(len(pos))
+        moving = np.ones(len(pos), dtype=bool)
+        half = np.where(circle[:, None], size[:, 0:1], size) / 2  # the circle is inscribed in the width
+
+        for _ in range(Settings.collision_iterations):
+            disp = vel * remaining[:, None]
+            moving &= (disp != 0).any(axis=1)
+            rows = np.flatnonzero(moving)
+            if not len(rows):
+                break
+
+            impact_t, normal_x, normal_y = np.full(len(rows), np.inf), np.zeros(len(rows)), np.zeros(len(rows))
+            if len(self.colliders):
+                chunk = max(1, self.chunk_cells // len(self.colliders))
+                for start in range(0, len(rows), chunk):
+                    part = rows[start:start + chunk]
+                    body, rect = self.swept_pairs(pos[part], size[part], disp[part])
+                    t, nx, ny = self.sweep(pos[part][body], size[part][body], half[part][body], circle[part][body], disp[part][body], self.colliders[rect])
+
+                    # the first impact of each body, the first rect in the order of the colliders on a tie
+                    order = np.lexsort((rect, t, body))
+                    body, t, nx, ny = body[order], t[order], nx[order], ny[order]
+                    first = np.flatnonzero(np.isfinite(t) & np.r_[True, body[1:] != body[:-1]])
+                    impact_t[start + body[first]] = t[first]
+                    normal_x[start + body[first]], normal_y[start + body[first]] = nx[first], ny[first]
+
+            hit = np.isfinite(impact_t)
+            free = rows[~hit]
+            pos[free] += disp[free]
+            moving[free] = False
+
+            rows, t, normal_x, normal_y = rows[hit], impact_t[hit], normal_x[hit], normal_y[hit]
+            pos[rows] += disp[rows] * t[:, None]
+            remaining[rows] *= 1 - t
+
+            into = vel[rows, 0] * normal_x + vel[rows, 1] * normal_y
+            vel[rows, 0] -= into * normal_x
+            vel[rows, 1] -= into * normal_y
+
+            touching[rows] = True
+            can_jump[rows] |= normal_y < -0.5  # standing on something not steeper than 60°
+
+        return touching, can_jump
+
+    def swept_pairs(self, pos, size, disp):
+        # (body, collider) index pairs of the rects touching the area swept by each box
+        x0, x1 = np.where(disp[:, 0] > 0, pos[:, 0], pos[:, 0] + disp[:, 0]), np.where(disp[:, 0] > 0, pos[:, 0] + size[:, 0] + disp[:, 0], pos[:, 0] + size[:, 0])
+        y0, y1 = np.where(disp[:, 1] > 0, pos[:, 1], pos[:, 1] + disp[:, 1]), np.where(disp[:, 1] > 0, pos[:, 1] + size[:, 1] + disp[:, 1], pos[:, 1] + size[:, 1])
+        rects = self.colliders
+        touched = (rects[None, :, 0] <= x1[:, None]) & (rects[None, :, 2] >= x0[:, None]) & (rects[None, :, 1] <= y1[:, None]) & (rects[None, :, 3] >= y0[:, None])
+        return np.nonzero(touched)
+
+    def sweep(self, pos, size, half, circle, disp, rects):
+        # Physics.sweep for pairs of body and rect (one per row of the arguments): (t, normal_x, normal_y) arrays,
+        # t is inf where there is no impact
+        eps = contact_epsilon
+        rx0, ry0, rx1, ry1 = rects[:, 0], rects[:, 1], rects[:, 2], rects[:, 3]
+        center_x, center_y = pos[:, 0] + size[:, 0] / 2, pos[:, 1] + size[:, 1] / 2
+        dx, dy = disp[:, 0], disp[:, 1]
+        hx, hy = half[:, 0], half[:, 1]
+        valid = np.ones(len(pos), dtype=bool)
+
+        # the center against the rects grown by the body
+        x0, y0, x1, y1 = rx0 - hx, ry0 - hy, rx1 + hx, ry1 + hy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            near_x, far_x = np.where(dx > 0, (x0 - center_x) / dx, (x1 - center_x) / dx), np.where(dx > 0, (x1 - center_x) / dx, (x0 - center_x) / dx)
+            near_y, far_y = np.where(dy > 0, (y0 - center_y) / dy, (y1 - center_y) / dy), np.where(dy > 0, (y1 - center_y) / dy, (y0 - center_y) / dy)
+        near_x, far_x = np.where(dx == 0, -np.inf, near_x), np.where(dx == 0, np.inf, far_x)
+        near_y, far_y = np.where(dy == 0, -np.inf, near_y), np.where(dy == 0, np.inf, far_y)
+        valid &= (dx != 0) | ((x0 + eps < center_x) & (center_x < x1 - eps))
+        valid &= (dy != 0) | ((y0 + eps < center_y) & (center_y < y1 - eps))
+
+        y_axis = (dy != 0) & (near_y > near_x)  # the axis entered last gives the normal
+        entry, leave = np.where(y_axis, near_y, near_x), np.minimum(far_x, far_y)
+        valid &= (entry < leave) & (entry <= 1)
+
+        t = np.maximum(entry, 0)
+        normal_x = np.where(y_axis, 0.0, np.where(dx > 0, -1.0, 1.0))
+        normal_y = np.where(y_axis, np.where(dy > 0, -1.0, 1.0), 0.0)
+        hit_x, hit_y = center_x + dx * t, center_y + dy * t
+        inside = entry * np.where(y_axis, np.abs(dy), np.abs(dx)) < -eps
+
+        # boxes: touching only by a corner is not an impact
+        on_side = np.where(y_axis, (x0 + eps < hit_x) & (hit_x < x1 - eps), (y0 + eps < hit_y) & (hit_y < y1 - eps))
+        box = valid & ~inside & on_side
+
+        # circles: past the sides of the rect, the circle hits the corner point
+        corner_x = np.where(hit_x < rx0, rx0, np.where(hit_x > rx1, rx1, np.nan))
+        corner_y = np.where(hit_y < ry0, ry0, np.where(hit_y > ry1, ry1, np.nan))
+        at_corner = ~np.isnan(corner_x) & ~np.isnan(corner_y)
+        side = valid & ~at_corner & ~inside
+
+        rel_x, rel_y = center_x - corner_x, center_y - corner_y
+        a = dx * dx + dy * dy
+        b = 2 * (rel_x * dx + rel_y * dy)
+        c = rel_x * rel_x + rel_y * rel_y - hx * hx
+        discriminant = b * b - 4 * a * c
+        with np.errstate(invalid='ignore'):
+            corner_t = (-b - np.sqrt(discriminant)) / (2 * a)
+            corner = valid & at_corner & (discriminant >= 0) & (corner_t <= 1) & (corner_t * np.sqrt(a) >= -eps)
+        corner_t = np.maximum(corner_t, 0)
+        corner_normal_x, corner_normal_y = (rel_x + dx * corner_t) / hx, (rel_y + dy * corner_t) / hx
+        corner &= dx * corner_normal_x + dy * corner_normal_y < 0  # not leaving or sliding along the corner
+
+        corner &= circle
+        t = np.where(corner, corner_t, t)
+        normal_x, normal_y = np.where(corner, corner_normal_x, normal_x), np.where(corner, corner_normal_y, normal_y)
+        t = np.where(np.where(circle, side | corner, box), t, np.inf)
+        return t, normal_x, normal_y
@@ -0,0 +1,65 @@
+# benchmark of the framed wire protocol: round trips of messages of growing size between two sockets, up to the
+# message size limit, and the cost of rejecting a message over the limit
+# example: python benchmarks/framing.py --max-size 4194304
+import argparse
+import socket
+import threading
+import time
+
+from OnlineGraph2d.Network import send_message, recv_message, max_message_size
+
+from suite import percentiles
+
+
+def echo(sock, max_size):
+    while True:
+        message = recv_message(sock, max_size)
+        if message is None:
+            break
+        send_message(sock, message, max_size)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-size', type=int, default=max_message_size, help='message size limit of both sides')
+    parser.add_argument('--rounds', type=int, default=200, help='round trips per message size')
+    parser.add_argument('--tcp', action='store_true', help='loopback TCP instead of a socketpair')
+    args = parser.parse_args()
+
+    if args.tcp:
+        listener = socket.create_server(('127.0.0.1', 0))
+        client = socket.create_connection(listener.getsockname())
+        server = listener.accept()[0]
+        listener.close()
+    else:
+        client, server = socket.socketpair()
+    threading.Thread(target=echo, args=(server, args.max_size), daemon=True).start()
+
+    size = 1024
+    while size <= args.max_size:
+        payload = bytes(range(256)) * (size // 256)
+        times = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            send_message(client, payload, args.max_size)
+            if recv_message(client, args.max_size) != payload:
+                raise Exception(f'message of {size} bytes corrupted')
+            times.append(time.perf_counter() - start)
+
+        p = percentiles(times)
+        print(f'  {f"{size // 1024} KiB":12} round trip p50 {p[50]:8.3f} ms  p99 {p[99]:8.3f} ms  {2 * size / (sum(times) / len(times)) / 2 ** 20:10.1f} MiB/s')
+        size *= 4
+
+    # over the limit: rejected by the sender before anything is written
+    start = time.perf_counter()
+    try:
+        send_message(client, bytes(args.max_size + 1), args.max_size)
+    except ValueError as e:
+        print(f'  over the limit: rejected in {(time.perf_counter() - start) * 1000:.3f} ms ({e})')
+
+    client.close()
+    server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# streaming benchmark for the level format: a huge random map is saved as a level, then a camera flies across it
+# while LevelStreamer loads and evicts the chunks around it, compared with loading and baking the whole map
+# example: python benchmarks/level_stream.py --width 200000
+import argparse
+import os
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from OnlineGraph2d.Graphics import Renderer
+from OnlineGraph2d.Headless import init, make_map
+from OnlineGraph2d.Level import Level, LevelStreamer, save_level, object_record
+from OnlineGraph2d.Physics import SpatialHash
+
+from suite import percentiles
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=200000)
+    parser.add_argument('--height', type=int, default=4000)
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--speed', type=float, default=40, help='camera pixels per frame')
+    parser.add_argument('--path', default='level_stream.level')
+    args = parser.parse_args()
+
+    init()
+    screen_size = (1600, 900)
+    game_map = make_map((args.width, args.height))
+    save_level(args.path, game_map, chunk_size=args.chunk_size)
+    print(f'{len(game_map)} objects, {os.path.getsize(args.path) / 1024:.1f} KiB on disk ({len(game_map) * object_record.size / 1024:.1f} KiB of records)')
+    del game_map
+
+    # everything at once
+    tracemalloc.start()
+    start = time.perf_counter()
+    level = Level(args.path)
+    collision, renderer = SpatialHash(), Renderer()
+    objects = level.load_all()
+    for i, obj in enumerate(objects):
+        collision.insert(('map', i), obj.pos, obj.size)
+    renderer.bake(objects)
+    full_time = time.perf_counter() - start
+    full_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    full_chunks = sum(len(chunks) for chunks in renderer.chunks.values())
+    level.close()
+    del objects, collision, renderer
+
+    # streamed
+    tracemalloc.start()
+    start = time.perf_counter()
+    level = Level(args.path)
+    collision, renderer = SpatialHash(), Renderer()
+    streamer = LevelStreamer(level, collision, renderer)
+    camera = SimpleNamespace(pos=[0, args.height - screen_size[1]], screen_size=screen_size)
+    streamer.update(camera)
+    startup_time = time.perf_counter() - start
+
+    times, max_objects, max_chunks = [], 0, 0
+    while camera.pos[0] < args.width - screen_size[0]:
+        camera.pos[0] += args.speed
+        start = time.perf_counter()
+        streamer.update(camera)
+        times.append(time.perf_counter() - start)
+        max_objects = max(max_objects, len(streamer.objects))
+        max_chunks = max(max_chunks, sum(len(chunks) for chunks in renderer.chunks.values()))
+    stream_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    level.close()
+    os.remove(args.path)
+
+    print(f'  {"full_load_s":32} {full_time:12.3f}')
+    print(f'  {"full_peak_mib":32} {full_peak / 2 ** 20:12.3f} (render chunks: {full_chunks}, surfaces not traced)')
+    print(f'  {"stream_startup_ms":32} {startup_time * 1000:12.3f}')
+    print(f'  {"stream_peak_mib":32} {stream_peak / 2 ** 20:12.3f} (render chunks: {max_chunks} at most, surfaces not traced)')
+    print(f'  {"stream_max_objects":32} {max_objects:12}')
+    for p, value in percentiles(times).items():
+        print(f'  {f"stream_update_p{p}_ms":32} {value:12.3f}')
+    print(f'  {"stream_update_max_ms":32} {max(times) * 1000:12.3f}')
+
+
+if __name__ == '__main__':
+    main()
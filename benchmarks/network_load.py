@@ -0,0 +1,139 @@
+# load benchmark for the Network servers: the server runs in its own process and is driven by many fake clients
+# example: python benchmarks/network_load.py --backend selector --clients 200 --tick-rate 30
+#          python benchmarks/network_load.py --backend rooms --rooms 50 --clients 400 (many matches on every core)
+import argparse
+import contextlib
+import multiprocessing
+import os
+import pickle
+import selectors
+import socket
+import time
+
+from OnlineGraph2d.Network import Server, SelectorServer, RoomServer, Room, header, frame
+
+backends = {'thread': Server, 'selector': SelectorServer, 'rooms': RoomServer}
+
+
+class LoadRoom(Room):
+    # a match of entities entities, one of them changes every tick
+    def __init__(self, name, entities=200, **kwargs):
+        super().__init__(name, **kwargs)
+        self.entities = {entity_id: bytes(52) for entity_id in range(entities)}
+        self.frame_number = 0
+
+    def update(self, received):
+        self.frame_number += 1
+        moving = self.frame_number % len(self.entities)
+        self.entities[moving] = moving.to_bytes(4, 'big') + self.frame_number.to_bytes(48, 'big')
+        return self.entities
+
+
+def run_server(backend, port, delta, tick_rate, entities, seconds, fps=120, workers=None):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # hide the connection logs
+        serve(backend, port, delta, tick_rate, entities, seconds, fps, workers)
+
+
+def serve(backend, port, delta, tick_rate, entities, seconds, fps, workers):
+    if backend == 'rooms':  # the rooms run their own ticks in the worker processes
+        server = RoomServer('127.0.0.1', port, room=LoadRoom, workers=workers, tick_rate=tick_rate, delta=delta, entities=entities)
+        time.sleep(seconds)
+        server.close()
+        return
+
+    server = backends[backend]('127.0.0.1', port, delta=delta, tick_rate=tick_rate)
+    snapshot = {entity_id: bytes(52) for entity_id in range(entities)}
+
+    frame_number = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        frame_number += 1
+        moving = frame_number % entities
+        snapshot[moving] = moving.to_bytes(4, 'big') + frame_number.to_bytes(48, 'big')  # one entity changes per frame
+        server.send(snapshot)
+        time.sleep(1 / fps)
+
+
+def run_clients(port, clients, delta, send_rate, seconds, warmup=1, rooms=0):
+    selector = selectors.DefaultSelector()
+    states = {}  # socket: [incoming bytes, ack, messages received, bytes received]
+
+    for i in range(clients):
+        sock = socket.create_connection(('127.0.0.1', port))
+        if rooms:
+            sock.sendall(frame(pickle.dumps(f'room {i % rooms}')))
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        states[sock] = [bytearray(), None, 0, 0]
+
+    latencies = []
+    next_send = time.perf_counter()
+    start = next_send + warmup  # snapshots queued while the clients were connecting are not counted
+    end = start + seconds
+
+    while time.perf_counter() < end:
+        if start is not None and time.perf_counter() >= start:
+            for state in states.values():
+                state[2] = state[3] = 0
+            latencies, start = [], None
+
+        for key, _ in selector.select(max(0, next_send - time.perf_counter())):
+            state = states[key.fileobj]
+            data = key.fileobj.recv(1024 * 64)
+            state[0] += data
+            state[3] += len(data)
+
+            while len(state[0]) >= header.size and len(state[0]) >= header.size + header.unpack_from(state[0])[0]:
+                size = header.unpack_from(state[0])[0]
+                message = pickle.loads(bytes(state[0][header.size:header.size + size]))
+                del state[0][:header.size + size]
+
+                state[2] += 1
+                if delta and isinstance(message, tuple):
+                    state[1] = message[0]
+
+        now = time.perf_counter()
+        if now >= next_send:
+            for sock, state in states.items():
+                sent_at = time.perf_counter()
+                sock.sendall(frame(pickle.dumps((state[1], now) if delta else now)))
+                latencies.append(time.perf_counter() - sent_at)
+            next_send += 1 / send_rate
+
+    elapsed = seconds
+    for sock in states:
+        sock.close()
+
+    messages = [state[2] for state in states.values()]
+    received = sum(state[3] for state in states.values())
+    latencies.sort()
+
+    print(f'clients: {clients}, duration: {elapsed:.1f}s')
+    print(f'snapshots per client per second: min {min(messages) / elapsed:.1f}, mean {sum(messages) / len(messages) / elapsed:.1f}')
+    print(f'bytes received per second: {received / elapsed:.0f}')
+    print(f'client send time: p50 {latencies[len(latencies) // 2] * 1e6:.0f}us, p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f}us')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=backends, default='selector')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--tick-rate', type=int, default=30)
+    parser.add_argument('--entities', type=int, default=200)
+    parser.add_argument('--delta', action='store_true')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--port', type=int, default=5599)
+    parser.add_argument('--rooms', type=int, default=10, help='rooms backend: the clients are spread over this many rooms')
+    parser.add_argument('--workers', type=int, help='rooms backend: worker processes, default: one per core')
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=run_server, args=(args.backend, args.port, args.delta, args.tick_rate, args.entities, args.seconds + 3, 120, args.workers), daemon=False if args.backend == 'rooms' else True)  # daemons can't start the worker processes
+    server.start()
+    time.sleep(0.5)
+
+    run_clients(args.port, args.clients, args.delta, args.tick_rate, args.seconds, rooms=args.rooms if args.backend == 'rooms' else 0)
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
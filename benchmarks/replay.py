@@ -0,0 +1,77 @@
+# replays a recorded match offline (see Server(recorder=...) and Replay.Recorder) through the headless renderer
+# with the profiler on, to look into the spikes of a real match
+# example: python benchmarks/replay.py match.rec --trace replay.json
+#          python benchmarks/replay.py match.rec --record crowd --ticks 3000 (records a scripted match first)
+import argparse
+import random
+import time
+
+from OnlineGraph2d.Codec import encode, split
+from OnlineGraph2d.Headless import Simulation, Playback
+from OnlineGraph2d.Network import SelectorServer
+from OnlineGraph2d.Profiler import profiler
+from OnlineGraph2d.Replay import Recorder
+
+from suite import scenarios, percentiles
+
+
+def record(path, scenario, ticks):
+    # a scripted match sent by a server the way Faltura does it, every client owning one player
+    simulation = Simulation(render=False, **scenario)
+    with Recorder(path) as recorder:
+        server = SelectorServer('127.0.0.1', 0, delta=True, recorder=recorder)  # any free port, no client needed
+        for _ in range(ticks):
+            simulation.step()
+            packets = {number: encode([player, gun]) for number, (player, gun) in enumerate(zip(simulation.players, simulation.guns))}
+            packets[len(packets)] = encode(simulation.bullets)
+            server.send({(number, entity_id): entity_record for number, packet in packets.items() for entity_id, entity_record in split(packet).items()})
+        server.close()
+    return simulation.game_map
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--record', choices=scenarios, help='record this scenario to path before replaying it')
+    parser.add_argument('--ticks', type=int, default=3000, help='ticks to record')
+    parser.add_argument('--no-render', action='store_true', help='decode only')
+    parser.add_argument('--seeks', type=int, default=200, help='random seeks to time')
+    parser.add_argument('--trace', help='write a Chrome trace of the replay to this json file')
+    args = parser.parse_args()
+
+    game_map = record(args.path, scenarios[args.record], args.ticks) if args.record else ()
+
+    playback = Playback(args.path, game_map=game_map, render=not args.no_render)
+    ticks = len(playback.replay)
+    print(f'{args.path}: {ticks} ticks, {playback.replay.time(ticks - 1) if ticks else 0:.1f} s recorded')
+
+    profiler.enable(tracing=bool(args.trace))
+    times = []
+    while True:
+        start = time.perf_counter()
+        if not playback.step():
+            break
+        times.append(time.perf_counter() - start)
+    profiler.disable()
+
+    seek_times, rng = [], random.Random(0)
+    for _ in range(args.seeks if ticks else 0):
+        tick = rng.randrange(ticks)
+        start = time.perf_counter()
+        playback.replay.snapshot(tick)
+        seek_times.append(time.perf_counter() - start)
+
+    print(f'  {"ticks_per_second":32} {len(times) / sum(times) if times else 0:12.3f}')
+    for p, value in percentiles(times or [0]).items():
+        print(f'  {f"tick_p{p}_ms":32} {value:12.3f}')
+    for p, value in percentiles(seek_times or [0]).items():
+        print(f'  {f"seek_p{p}_ms":32} {value:12.3f}')
+    for metric, (mean, peak) in profiler.stats().items():
+        print(f'  {metric:32} {mean:12.3f} (max {peak:.3f})')
+
+    if args.trace:
+        profiler.dump_trace(args.trace)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# repeatable benchmark suite: every scenario is run headless through physics, rendering and loopback networking
+# examples:
+#   python benchmarks/suite.py --save baseline.json
+#   python benchmarks/suite.py --compare baseline.json --threshold 0.15
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from OnlineGraph2d.Codec import encode, split, position
+from OnlineGraph2d.Headless import Simulation
+from OnlineGraph2d.Network import SelectorServer, Client
+from OnlineGraph2d.Profiler import profiler
+
+scenarios = {
+    'duel': dict(players=2, bullets=20, map_size=(3000, 1500)),
+    'crowd': dict(players=16, bullets=200, map_size=(8000, 3000)),
+    'big_map': dict(players=4, bullets=50, map_size=(40000, 8000)),
+}
+
+higher_is_better = {'physics_ticks_per_second', 'render_fps', 'network_ticks_per_second', 'network_ticks_per_second_interest'}
+
+
+class CountingClient(Client):
+    def __init__(self, *args, **kwargs):
+        self.bytes_received = 0
+        super().__init__(*args, **kwargs)
+
+    def recv_payload(self):
+        payload = super().recv_payload()
+        self.bytes_received += len(payload)
+        return payload
+
+
+def percentiles(times):
+    times = sorted(times)
+    return {p: times[min(len(times) - 1, int(len(times) * p / 100))] * 1000 for p in (50, 95, 99)}
+
+
+def run_frames(simulation, frames):
+    times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        simulation.step()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_physics(scenario, frames):
+    simulation = Simulation(render=False, **scenario)
+    times = run_frames(simulation, frames)
+    result = {f'physics_p{p}_ms': value for p, value in percentiles(times).items()}
+    result['physics_ticks_per_second'] = frames / sum(times)
+
+    # allocations: memory still held after the frames and garbage collections triggered by the frames
+    gc.collect()
+    collections = sum(stat['collections'] for stat in gc.get_stats())
+    tracemalloc.start()
+    run_frames(simulation, frames)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result['alloc_peak_kib'] = peak / 1024
+    result['alloc_retained_kib'] = current / 1024
+    result['gc_collections_per_1000_frames'] = (sum(stat['collections'] for stat in gc.get_stats()) - collections) * 1000 / frames
+    return result
+
+
+def bench_render(scenario, frames):
+    simulation = Simulation(render=True, **scenario)
+    run_frames(simulation, 10)  # fill the surface cache
+
+    start = time.perf_counter()
+    times = []
+    for _ in range(frames):
+        frame_start = time.perf_counter()
+        simulation.display.fill((0, 0, 0))
+        simulation.renderer.render(display=simulation.display, camera=simulation.camera, objects=simulation.objects())
+        times.append(time.perf_counter() - frame_start)
+        simulation.step()
+
+    result = {f'render_p{p}_ms': value for p, value in percentiles(times).items()}
+    result['render_fps'] = frames / sum(times)
+    result['render_objects'] = simulation.renderer.rendered
+    return result
+
+
+def bench_network(scenario, ticks, interest_radius=None):
+    # with interest_radius, every client only gets the entities around the view of its player
+    simulation = Simulation(render=False, **scenario)
+    server = SelectorServer('127.0.0.1', 0, delta=True, interest_radius=interest_radius, position=position if interest_radius is not None else None)  # any free port
+    clients = [CountingClient('127.0.0.1', server.sock.getsockname()[1], delta=True) for _ in simulation.players]
+
+    times, sent = [], 0
+    for _ in range(ticks):
+        simulation.step()
+        start = time.perf_counter()
+
+        # every client owns one player, the server relays everything as per entity delta snapshots
+        packets = {client.client_number: encode([player, gun]) for client, player, gun in zip(clients, simulation.players, simulation.guns)}
+        packets[0] = encode(simulation.bullets)
+        server.send({(number, entity_id): record for number, packet in packets.items() for entity_id, record in split(packet).items()})
+        for client, player in zip(clients, simulation.players):
+            if interest_radius is not None:
+                client.set_view((player.pos[0] - simulation.camera.screen_size[0] / 2, player.pos[1] - simulation.camera.screen_size[1] / 2), simulation.camera.screen_size)
+            sent += len(packets[client.client_number])
+            client.send(packets[client.client_number])
+
+        times.append(time.perf_counter() - start)
+
+    server.close()
+    for client in clients:
+        client.sock.close()
+
+    result = {f'network_p{p}_ms': value for p, value in percentiles(times).items()}
+    result['network_ticks_per_second'] = ticks / sum(times)
+    result['bytes_per_tick_down'] = sum(client.bytes_received for client in clients) / ticks
+    result['bytes_per_tick_up'] = sent / ticks
+    return result if interest_radius is None else {f'{metric}_interest': value for metric, value in result.items()}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+
+            change = (value - old) / old
+            worse = -change if metric in higher_is_better else change
+            flag = '  REGRESSION' if worse > threshold else ''
+            print(f'{name:10} {metric:32} {old:12.3f} -> {value:12.3f} ({change:+.1%}){flag}')
+            if flag:
+                regressions.append((name, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', choices=scenarios, action='append', help='default: every scenario')
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--compare', help='json file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    parser.add_argument('--interest-radius', type=float, default=500, help='margin around the views for the interest management run')
+    parser.add_argument('--trace', help='write a Chrome trace of the run to this json file (slows the run down)')
+    args = parser.parse_args()
+
+    if args.trace:
+        profiler.enable(tracing=True)
+
+    results = {}
+    for name in args.scenario or scenarios:
+        scenario = scenarios[name]
+        results[name] = bench_physics(scenario, args.frames) | bench_render(scenario, args.frames) | bench_network(scenario, args.ticks) | bench_network(scenario, args.ticks, interest_radius=args.interest_radius)
+
+        print(f'\n{name}: {scenario}')
+        for metric, value in results[name].items():
+            print(f'  {metric:32} {value:12.3f}')
+
+    if args.trace:
+        for metric, (mean, peak) in profiler.stats().items():
+            print(f'  {metric:32} {mean:12.3f} (max {peak:.3f})')
+        profiler.dump_trace(args.trace)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        print()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ setup(
     version="0.1.0",
     packages=find_packages(include=['OnlineGraph2d']),
     install_requires=['pygame>=2.0.0'],
+    extras_require={'world': ['numpy']},
     author='Gabriele Viganò',
     description='A small Python library to create 2D online games'
 )